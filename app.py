@@ -1,36 +1,378 @@
+import time
+
+# Startup is timed from here; see "startup" in /stats
+STARTUP_BEGAN = time.perf_counter()
+
+import atexit
+import json
 import os
-import pickle
-from flask import Flask, request, jsonify, send_from_directory
-from langchain_community.vectorstores import FAISS
-from langchain_huggingface import HuggingFaceEmbeddings
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from flask import Flask, Response, request, jsonify, send_from_directory
 from flask_cors import CORS
-from rapidfuzz import fuzz
+
+import storage
+from embedding_server import RemoteEmbeddingModel
+from embeddings import (
+    CachedEmbedder,
+    EmbeddingCache,
+    EmbeddingEngine,
+    LazyEmbeddingModel,
+    QueryBatcher,
+    QueryEmbeddingCache,
+    model_cache_name,
+)
+from jobs import JobRegistry
+
+startup_timings = {"imports_seconds": time.perf_counter() - STARTUP_BEGAN}
 
 # ---------- Step 1: Init ----------
 app = Flask(__name__)
 CORS(app)
 
-embedding_model = HuggingFaceEmbeddings(model_name="sentence-transformers/paraphrase-MiniLM-L6-v2")
+EMBEDDING_MODEL_NAME = "sentence-transformers/paraphrase-MiniLM-L6-v2"
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 32))
+# EMBEDDING_BACKEND=onnx runs an export from onnx_embeddings.py (see ONNX_MODEL_DIR)
+embedding_model_spec = {
+    "backend": os.environ.get("EMBEDDING_BACKEND", "torch"),
+    "model_name": EMBEDDING_MODEL_NAME,
+    "batch_size": EMBEDDING_BATCH_SIZE,
+    "onnx_dir": os.environ.get("ONNX_MODEL_DIR"),
+    "quantized": os.environ.get("ONNX_QUANTIZED") == "1",
+    "threads": int(os.environ.get("EMBEDDING_THREADS", 0)),
+    # Local copy of the weights (the Docker image bakes one in); unset loads from the Hub
+    "model_path": os.environ.get("EMBEDDING_MODEL_PATH"),
+}
+# EMBEDDING_SERVER=<unix socket> embeds in embedding_server.py processes and
+# keeps the model out of the web workers altogether.
+EMBEDDING_SERVER = os.environ.get("EMBEDDING_SERVER")
+if EMBEDDING_SERVER:
+    embedding_model = RemoteEmbeddingModel(EMBEDDING_SERVER, model_cache_name(embedding_model_spec))
+else:
+    # Loaded on first embed so the container can start serving without torch;
+    # EMBEDDING_PRELOAD=1 loads it during startup instead.
+    embedding_model = LazyEmbeddingModel(embedding_model_spec)
+
+# Upload-side embedding: length-sorted batches, optionally sharded across processes
+embedding_engine = EmbeddingEngine(
+    embedding_model,
+    embedding_model_spec,
+    batch_size=EMBEDDING_BATCH_SIZE,
+    max_batch_tokens=int(os.environ.get("EMBEDDING_MAX_BATCH_TOKENS", EMBEDDING_BATCH_SIZE * 128)),
+    # With EMBEDDING_SERVER the server's workers take the place of a local process pool
+    processes=0 if EMBEDDING_SERVER else int(os.environ.get("EMBEDDING_PROCESSES", 0)),
+    process_threshold=int(os.environ.get("EMBEDDING_PROCESS_THRESHOLD", 5000)),
+)
+
+# Concurrent query encodes (cache misses) share one forward pass
+query_batcher = QueryBatcher(
+    embedding_model,
+    max_batch=int(os.environ.get("QUERY_BATCH_SIZE", 32)),
+    max_wait_ms=float(os.environ.get("QUERY_BATCH_MAX_WAIT_MS", 2)),
+)
+
+# Query vectors are shared by all tenants; set QUERY_EMBEDDING_CACHE_FILE to keep them across restarts
+query_embedder = QueryEmbeddingCache(
+    query_batcher,
+    model_cache_name(embedding_model_spec),
+    max_entries=int(os.environ.get("QUERY_EMBEDDING_CACHE_SIZE", 50000)),
+    path=os.environ.get("QUERY_EMBEDDING_CACHE_FILE") or None,
+)
+atexit.register(query_embedder.save)
+
+# Document vectors are cached on disk by content hash, across uploads and tenants
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR", "embedding_cache")
+document_embedder = CachedEmbedder(
+    embedding_engine, EmbeddingCache(EMBEDDING_CACHE_DIR, model_cache_name(embedding_model_spec))
+)
 
 # Local directory for vectorstores
 VECTOR_DB_DIR = "vector_dbs"
 os.makedirs(VECTOR_DB_DIR, exist_ok=True)
 
+# FAISS index structure by KB size (see vector_index.py); FAISS_INDEX_TYPE
+# forces one of flat / hnsw / ivf for every KB. FAISS_COMPRESSION=fp16|sq8|pq
+# shrinks the in-memory vectors, FAISS_RERANK=N re-ranks N*k candidates
+# exactly from the vectors on disk. FAISS_HNSW_MAX_DELETED is the share of
+# removed vectors an HNSW graph keeps before it is rebuilt. Applied when a KB
+# is written.
+INDEX_OPTIONS = {
+    "type": os.environ.get("FAISS_INDEX_TYPE", "auto"),
+    "hnsw_min_docs": int(os.environ.get("FAISS_HNSW_MIN_DOCS", 20000)),
+    "ivf_min_docs": int(os.environ.get("FAISS_IVF_MIN_DOCS", 250000)),
+    "hnsw_m": int(os.environ.get("FAISS_HNSW_M", 32)),
+    "ef_search": int(os.environ.get("FAISS_EF_SEARCH", 64)),
+    "hnsw_max_deleted": float(os.environ.get("FAISS_HNSW_MAX_DELETED", 0.1)),
+    "nprobe": int(os.environ.get("FAISS_NPROBE", 0)),
+    "compression": os.environ.get("FAISS_COMPRESSION", "none"),
+    "pq_m": int(os.environ.get("FAISS_PQ_M", 0)),
+    "rerank": int(os.environ.get("FAISS_RERANK", 0)),
+}
+
+# Tenants with at most POOL_MAX_DOCS docs share one pooled KB instead of a
+# dedicated index each (see storage.py); they move to their own KB once they
+# grow past it. 0 gives every tenant a dedicated KB.
+POOL_MAX_DOCS = int(os.environ.get("POOL_MAX_DOCS", 0))
+
+if os.environ.get("EMBEDDING_PRELOAD") == "1":
+    embedding_model.get()
+
 # ---------- Step 2: Helper Functions ----------
 def get_tenant_db_path(tenant_id: str) -> str:
-    return os.path.join(VECTOR_DB_DIR, f"{tenant_id}.pkl")
+    return storage.tenant_dir(VECTOR_DB_DIR, tenant_id)
 
 def load_vectorstore(tenant_id: str):
-    path = get_tenant_db_path(tenant_id)
-    if os.path.exists(path):
-        with open(path, "rb") as f:
-            return pickle.load(f)
-    return None
+    vectorstore = storage.load_tenant(VECTOR_DB_DIR, tenant_id)
+    if vectorstore is None:
+        # KBs uploaded before the native format are converted on first use
+        vectorstore = storage.migrate_legacy_pickle(VECTOR_DB_DIR, tenant_id, INDEX_OPTIONS)
+    if vectorstore is not None:
+        vectorstore.build_fuzzy()
+    return vectorstore
+
+def save_vectorstore(tenant_id: str, docs, delete_ids=(), replace=True, job=None):
+    # "docs" needed a vector: "cached" of them were in the embedding cache,
+    # "embedded" went through the model
+    report = {"docs": 0, "cached": 0, "embedded": 0, "seconds": 0.0, "docs_per_sec": 0.0}
+
+    def embed_texts(texts):
+        started = time.perf_counter()
+        progress = None
+        if job is not None:
+            job.set_embedding_total(len(texts))
+            progress = job.advance
+        vectors = document_embedder.embed_documents(texts, progress=progress, counts=report)
+        elapsed = time.perf_counter() - started
+        report.update(docs=len(texts), seconds=round(elapsed, 3), docs_per_sec=len(texts) / elapsed if elapsed else 0.0)
+        return vectors
+
+    # Only new or changed documents are embedded; the rest of the KB is patched
+    vectorstore, changes = storage.update_tenant_index(
+        VECTOR_DB_DIR, tenant_id, docs, embed_texts, delete_ids=delete_ids, replace=replace,
+        index_options=INDEX_OPTIONS, pool_max_docs=POOL_MAX_DOCS,
+    )
+    return vectorstore, changes, report
+
+class VectorstoreCache:
+    """Byte-bounded LRU of loaded tenant vectorstores.
+
+    Entries remember the version stamp of the KB they were loaded from, so a
+    KB replaced on disk (by this or another worker) is reloaded on the next
+    lookup. Sizes are the mapped bytes of the FAISS index, the docstore and
+    the fuzzy prefilter indexes. Concurrent misses for one tenant share a
+    single load: the first caller loads, the rest wait for its result.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # tenant_id -> vectorstore
+        self._loading = {}  # tenant_id -> Future of the load in flight
+        self._waiters = {}  # tenant_id -> callers waiting on it
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.loads = 0
+        self.load_seconds = 0.0
+        self.max_load_seconds = 0.0
+        self.coalesced = 0
+        self.max_waiters = 0
+
+    def get(self, tenant_id: str):
+        stamp = storage.current_stamp(VECTOR_DB_DIR, tenant_id)
+        with self._lock:
+            entry = self._entries.get(tenant_id)
+            if entry is not None:
+                if entry.stamp == stamp:
+                    self._entries.move_to_end(tenant_id)
+                    self.hits += 1
+                    return entry
+                self._drop(tenant_id)
+                self.invalidations += 1
+            self.misses += 1
+            load = self._loading.get(tenant_id)
+            leader = load is None
+            if leader:
+                load = self._loading[tenant_id] = Future()
+                self._waiters[tenant_id] = 0
+            else:
+                self._waiters[tenant_id] += 1
+                self.coalesced += 1
+                self.max_waiters = max(self.max_waiters, self._waiters[tenant_id])
+        if not leader:
+            return load.result()
+
+        started = time.perf_counter()
+        try:
+            vectorstore = load_vectorstore(tenant_id)
+            if vectorstore is not None:
+                self.put(tenant_id, vectorstore)
+            load.set_result(vectorstore)
+        except BaseException as e:
+            load.set_exception(e)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                del self._loading[tenant_id]
+                del self._waiters[tenant_id]
+                self.loads += 1
+                self.load_seconds += elapsed
+                self.max_load_seconds = max(self.max_load_seconds, elapsed)
+        return vectorstore
+
+    def put(self, tenant_id: str, vectorstore):
+        """Install a loaded or freshly saved vectorstore."""
+        with self._lock:
+            if tenant_id in self._entries:
+                self._drop(tenant_id)
+            # A KB larger than the whole budget is served uncached rather than
+            # flushing every other tenant out.
+            if vectorstore.nbytes > self.max_bytes:
+                return
+            while self._entries and self.current_bytes + vectorstore.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+                self.evictions += 1
+            self._entries[tenant_id] = vectorstore
+            self.current_bytes += vectorstore.nbytes
+
+    def invalidate(self, tenant_id: str):
+        with self._lock:
+            if tenant_id in self._entries:
+                self._drop(tenant_id)
+                self.invalidations += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "loads": self.loads,
+                "loading": len(self._loading),
+                "avg_load_seconds": self.load_seconds / self.loads if self.loads else 0.0,
+                "max_load_seconds": self.max_load_seconds,
+                "coalesced_waits": self.coalesced,
+                "max_waiters": self.max_waiters,
+            }
+
+    def _drop(self, tenant_id):
+        self.current_bytes -= self._entries.pop(tenant_id).nbytes
+
+vectorstore_cache = VectorstoreCache(int(os.environ.get("VECTORSTORE_CACHE_MB", 512)) * 1024 * 1024)
+
+# Tenants loaded at startup; under gunicorn's preload_app the workers share them copy-on-write
+PRELOAD_TENANTS = [t for t in os.environ.get("PRELOAD_TENANTS", "").split(",") if t]
+for tenant_id in PRELOAD_TENANTS:
+    vectorstore_cache.get(tenant_id)
+
+class ResultCache:
+    """TTL + LRU cache of final /search results.
 
-def save_vectorstore(tenant_id: str, vectorstore):
-    path = get_tenant_db_path(tenant_id)
-    with open(path, "wb") as f:
-        pickle.dump(vectorstore, f)
+    Keyed by (tenant, query as search() sees it, KB version): a new upload
+    changes the version, so stale results can never be served, and upload()
+    also drops the tenant's entries eagerly to free the space.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # (tenant_id, query, version) -> (expires_at, results)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, tenant_id: str, query: str, version: str):
+        key = (tenant_id, query, version)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, tenant_id: str, query: str, version: str, results):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[(tenant_id, query, version)] = (time.monotonic() + self.ttl_seconds, results)
+            self._entries.move_to_end((tenant_id, query, version))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate_tenant(self, tenant_id: str):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == tenant_id]:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+result_cache = ResultCache(
+    int(os.environ.get("RESULT_CACHE_SIZE", 10000)),
+    float(os.environ.get("RESULT_CACHE_TTL", 300)),
+)
+
+# rapidfuzz threads per fuzzy scoring call (-1: all cores)
+FUZZY_WORKERS = int(os.environ.get("FUZZY_WORKERS", -1))
+
+# Background workers for {"async": true} uploads
+upload_jobs = JobRegistry(
+    os.environ.get("UPLOAD_JOBS_DIR", "upload_jobs"),
+    workers=int(os.environ.get("UPLOAD_JOB_WORKERS", 2)),
+)
+
+startup_timings["init_seconds"] = time.perf_counter() - STARTUP_BEGAN - startup_timings["imports_seconds"]
+startup_timings["total_seconds"] = time.perf_counter() - STARTUP_BEGAN
+COLD_START_TARGET_SECONDS = float(os.environ.get("COLD_START_TARGET_SECONDS", 0))
+if COLD_START_TARGET_SECONDS and startup_timings["total_seconds"] > COLD_START_TARGET_SECONDS:
+    app.logger.warning(
+        "Startup took %.2fs, over the %.2fs target: %s",
+        startup_timings["total_seconds"], COLD_START_TARGET_SECONDS, startup_timings,
+    )
+
+def startup_stats() -> dict:
+    return dict(
+        startup_timings,
+        model_loaded=embedding_model.loaded,
+        model_load_seconds=embedding_model.load_seconds,
+        target_seconds=COLD_START_TARGET_SECONDS or None,
+    )
+
+def worker_stats() -> dict:
+    # Caches and counters in /stats belong to the worker process that answered
+    return {
+        "pid": os.getpid(),
+        "omp_threads": int(os.environ.get("OMP_NUM_THREADS", 0)) or None,
+        "embedding_threads": embedding_model_spec["threads"] or None,
+        "fuzzy_workers": FUZZY_WORKERS,
+    }
 
 # ---------- Step 3: Serve Frontend ----------
 @app.route("/")
@@ -44,98 +386,380 @@ def upload():
     data = request.json
     tenant_id = data.get("tenant_id")
     docs = data.get("docs", [])
+    # "replace" (default): the KB becomes exactly `docs`.
+    # "upsert": `docs` are added or updated by id/url and `delete` ids removed.
+    mode = data.get("mode", "replace")
+    delete_ids = data.get("delete", [])
 
-    if not tenant_id or not docs:
+    if mode not in ("replace", "upsert"):
+        return jsonify({"error": f"Unknown mode {mode}"}), 400
+    if not tenant_id or not (docs or (mode == "upsert" and delete_ids)):
         return jsonify({"error": "Missing tenant_id or docs"}), 400
+    if isinstance(tenant_id, int) and not isinstance(tenant_id, bool):
+        # Numeric ids were always accepted, and are searched for as text
+        tenant_id = str(tenant_id)
+    if not isinstance(tenant_id, str):
+        return jsonify({"error": "tenant_id must be a string"}), 400
+    if tenant_id == storage.POOL_DIR:
+        return jsonify({"error": f"Reserved tenant_id {tenant_id}"}), 400
+
+    docs = [
+        {
+            "id": d.get("id"),
+            "title": d.get("title", "Untitled"),
+            "url": d.get("url", ""),
+            "content": d["content"],
+        }
+        for d in docs
+    ]
+
+    replace = mode == "replace"
+
+    if data.get("async") or request.args.get("async") in ("1", "true"):
+        # Build in the background; searches keep hitting the current version
+        # until the new one is swapped in.
+        def run(job):
+            result = apply_upload(tenant_id, docs, delete_ids, replace, job=job)
+            if result is None:
+                raise LookupError(f"No KB found for tenant {tenant_id}")
+            return result
+
+        job = upload_jobs.submit(tenant_id, len(docs), run)
+        return jsonify({"job_id": job.id, "status": job.status, "status_url": f"/jobs/{job.id}"}), 202
+
+    result = apply_upload(tenant_id, docs, delete_ids, replace)
+    if result is None:
+        return jsonify({"error": f"No KB found for tenant {tenant_id}"}), 404
+    return jsonify(result)
 
-    texts = [d["content"] for d in docs]
-    metadatas = [{"title": d.get("title", "Untitled"), "url": d.get("url", "")} for d in docs]
+def apply_upload(tenant_id, docs, delete_ids, replace, job=None):
+    vectorstore, changes, embedding = save_vectorstore(tenant_id, docs, delete_ids, replace, job=job)
+    result_cache.invalidate_tenant(tenant_id)
+    if vectorstore is None:
+        vectorstore_cache.invalidate(tenant_id)
+        return None
+    vectorstore.build_fuzzy()
+    vectorstore_cache.put(tenant_id, vectorstore)
 
-    vectorstore = FAISS.from_texts(texts, embedding=embedding_model, metadatas=metadatas)
-    save_vectorstore(tenant_id, vectorstore)
+    return {
+        "message": f"✅ KB uploaded for tenant {tenant_id}",
+        "docs_added": len(docs),
+        "changes": changes,
+        "embedding": embedding,
+        "index": vectorstore.index_stats(),
+        "total_docs": len(vectorstore),
+    }
 
-    return jsonify({"message": f"✅ KB uploaded for tenant {tenant_id}", "docs_added": len(docs)})
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = upload_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job {job_id}"}), 404
+    return jsonify(job)
 
 # ---------- Step 5: API to Search KB ----------
-@app.route("/search", methods=["GET"])
-def search():
-    tenant_id = request.args.get("tenant_id")
-    query = request.args.get("query", "").lower()
+RESULT_LIMIT = 6
+SEMANTIC_K = 10
 
-    if not tenant_id or not query:
-        return jsonify({"error": "Missing tenant_id or query"}), 400
+class SearchStats:
+    """Counters for how often each search stage actually runs."""
 
-    vectorstore = load_vectorstore(tenant_id)
-    if not vectorstore:
-        return jsonify({"error": f"No KB found for tenant {tenant_id}"}), 404
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.searches = 0
+        self.semantic_runs = 0
+        self.semantic_skipped = 0
+        self.semantic_discarded = 0
+        self.over_budget = 0
+
+    def record(self, ran_semantic: bool, needed: bool = True):
+        # A semantic stage started early may run although the page was full
+        # without it: it counts as run, and as discarded
+        with self._lock:
+            self.searches += 1
+            if ran_semantic:
+                self.semantic_runs += 1
+                if not needed:
+                    self.semantic_discarded += 1
+            else:
+                self.semantic_skipped += 1
+
+    def record_over_budget(self):
+        with self._lock:
+            self.over_budget += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "searches": self.searches,
+                "semantic_runs": self.semantic_runs,
+                "semantic_skipped": self.semantic_skipped,
+                "semantic_skip_rate": self.semantic_skipped / self.searches if self.searches else 0.0,
+                "semantic_discarded": self.semantic_discarded,
+                "over_budget": self.over_budget,
+            }
+
+search_stats = SearchStats()
+
+# Threads running semantic stages beside their fuzzy stage, and the fuzzy
+# stages of a /search/batch in parallel
+search_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("SEARCH_WORKERS", 0)) or os.cpu_count() or 1,
+    thread_name_prefix="search",
+)
+SEARCH_BATCH_MAX = int(os.environ.get("SEARCH_BATCH_MAX", 256))
+# When the semantic stage starts beside the fuzzy one instead of after it:
+# "auto" when the bigram prefilter proves the fuzzy page will be short (so its
+# hits are always used) or leaves at least PARALLEL_SEARCH_MIN_ROWS rows to
+# score (so fuzzy is slow enough to hide a query embed and FAISS search, which
+# are wasted if fuzzy fills the page), "1" on every search, "0" never
+PARALLEL_SEARCH = os.environ.get("PARALLEL_SEARCH", "auto")
+PARALLEL_SEARCH_MIN_ROWS = int(os.environ.get("PARALLEL_SEARCH_MIN_ROWS", 1000))
+# Longest a search waits for its semantic stage, from the request's start;
+# past it the fuzzy page is served (and not cached). 0: no limit
+SEARCH_BUDGET_MS = float(os.environ.get("SEARCH_BUDGET_MS", 0))
 
-    # --- Semantic search
-    semantic_results = vectorstore.similarity_search_with_score(query, k=10)
-    semantic_hits = [
+def semantic_search(vectorstore, query: str) -> list:
+    query_vector = query_embedder.embed_query(query)
+    return semantic_hits(vectorstore.similarity_search_with_score_by_vector(query_vector, k=SEMANTIC_K))
+
+def semantic_hits(semantic_results: list) -> list:
+    return [
         {
-            "title": r.metadata.get("title", "Untitled"),
-            "url": r.metadata.get("url", ""),
-            "snippet": r.page_content[:200],
+            "title": r["title"],
+            "url": r["url"],
+            "snippet": r["content"][:200],
             "score": float(score),
             "source": "semantic"
         }
         for r, score in semantic_results
     ]
 
-    # --- Fuzzy search
-    all_docs = []
-    for doc in vectorstore.docstore._dict.values():
-        all_docs.append({
-            "title": doc.metadata.get("title", "Untitled"),
-            "url": doc.metadata.get("url", ""),
-            "content": doc.page_content
-        })
-
-    fuzzy_hits = []
-    for d in all_docs:
-        score_title = fuzz.partial_ratio(query, d["title"].lower())
-        score_content = fuzz.partial_ratio(query, d["content"].lower())
-        score = max(score_title, score_content)
-
-        if score >= 80:
-            if score_title == 100:
-                boosted_score = 200
-            elif score_content == 100:
-                boosted_score = 180
-            elif score_title > score_content:
-                boosted_score = score + 50
-            else:
-                boosted_score = score
-
-            fuzzy_hits.append({
-                "title": d["title"],
-                "url": d["url"],
-                "snippet": d["content"][:200],
-                "score": boosted_score,
-                "source": "fuzzy"
-            })
-
-    # Deduplicate & merge results
-    seen_urls = set()
-    final_results = []
-    for item in sorted(fuzzy_hits, key=lambda x: x["score"], reverse=True):
-        if len(final_results) >= 6:
+def merge_hits(final_results: list, seen_urls: set, hits: list):
+    # Deduplicate by URL, best score first, up to RESULT_LIMIT results
+    for item in sorted(hits, key=lambda x: x["score"], reverse=True):
+        if len(final_results) >= RESULT_LIMIT:
             break
         if item["url"] not in seen_urls:
             final_results.append(item)
             seen_urls.add(item["url"])
 
+def fuzzy_stage(vectorstore, query: str, candidates=None):
+    """The page after the fuzzy stage, its URLs, and whether the semantic stage must run."""
+    fuzzy_hits = vectorstore.fuzzy.search(query, workers=FUZZY_WORKERS, candidates=candidates)
+
+    seen_urls = set()
+    final_results = []
+    merge_hits(final_results, seen_urls, fuzzy_hits)
+
+    # The semantic stage is skipped when its hits could not make the page
     max_fuzzy_score = max([f['score'] for f in fuzzy_hits], default=0)
-    if len(final_results) < 6 or max_fuzzy_score < 80:
-        for item in sorted(semantic_hits, key=lambda x: x["score"], reverse=True):
-            if len(final_results) >= 6:
-                break
-            if item["url"] not in seen_urls:
-                final_results.append(item)
-                seen_urls.add(item["url"])
+    needs_semantic = len(final_results) < RESULT_LIMIT or max_fuzzy_score < 80
+    return final_results, seen_urls, needs_semantic
+
+def search_stages(vectorstore, query: str, started: float):
+    """Run a search, yielding (stage, page, final) as each stage completes.
+
+    With PARALLEL_SEARCH, the semantic stage starts on the search executor
+    while the fuzzy stage is scored here, so such a search takes about as long
+    as the slower of the two. Its hits are only merged when the fuzzy page
+    needs them, so the results are those of running the stages in turn.
+    Without a budget, a semantic stage no executor thread has picked up by
+    then runs here instead; with SEARCH_BUDGET_MS it always runs on the
+    executor (the lazy model load included), where it can be waited for with
+    a timeout. The last stage is "semantic", or "fuzzy" when that was
+    skipped, or "budget" when it outran SEARCH_BUDGET_MS.
+    """
+    candidates = vectorstore.fuzzy.candidates(query)
+    rows = candidates[2]
+    scored = len(vectorstore) if rows is None else len(rows)
+    # Fewer candidate rows than a page holds: the semantic stage will run
+    surely_short = rows is not None and len(rows) < RESULT_LIMIT
+    semantic = None
+    if PARALLEL_SEARCH == "1" or (PARALLEL_SEARCH == "auto" and (surely_short or scored >= PARALLEL_SEARCH_MIN_ROWS)):
+        semantic = search_executor.submit(semantic_search, vectorstore, query)
+    final_results, seen_urls, needs_semantic = fuzzy_stage(vectorstore, query, candidates)
+    if semantic is not None and (not needs_semantic or not SEARCH_BUDGET_MS) and semantic.cancel():
+        # Not picked up yet: run it below only if it is needed
+        semantic = None
+    search_stats.record(needs_semantic or semantic is not None, needed=needs_semantic)
+    if not needs_semantic:
+        yield "fuzzy", final_results, True
+        return
+    yield "fuzzy", final_results, False
+
+    if semantic is None and SEARCH_BUDGET_MS:
+        semantic = search_executor.submit(semantic_search, vectorstore, query)
+    if semantic is None:
+        hits = semantic_search(vectorstore, query)
+    else:
+        timeout = None
+        if SEARCH_BUDGET_MS:
+            timeout = max(0.0, started + SEARCH_BUDGET_MS / 1000 - time.perf_counter())
+        try:
+            hits = semantic.result(timeout)
+        except FutureTimeoutError:
+            semantic.cancel()
+            search_stats.record_over_budget()
+            yield "budget", final_results, True
+            return
+    merge_hits(final_results, seen_urls, hits)
+    yield "semantic", final_results, True
+
+def run_search(vectorstore, query: str, started: float = None):
+    """The final page, and whether it is complete (not cut short by the budget)."""
+    for stage, final_results, _ in search_stages(vectorstore, query, started or time.perf_counter()):
+        pass
+    return final_results, stage != "budget"
 
+def run_search_batch(pairs: list) -> list:
+    """run_search() for many (vectorstore, query) pairs, sharing the expensive steps.
+
+    Fuzzy stages run in parallel on the search executor, every query that
+    needs the semantic stage is embedded in one model pass, and each KB is
+    searched once with all of its query vectors.
+    """
+    staged = list(search_executor.map(lambda pair: fuzzy_stage(*pair), pairs))
+    semantic = [i for i, (_, _, needs_semantic) in enumerate(staged) if needs_semantic]
+    vectors = query_embedder.embed_queries([pairs[i][1] for i in semantic])
+
+    by_store = {}
+    for i, vector in zip(semantic, vectors):
+        by_store.setdefault(id(pairs[i][0]), []).append((i, vector))
+    for group in by_store.values():
+        vectorstore = pairs[group[0][0]][0]
+        results = vectorstore.similarity_search_with_score_by_vectors([v for _, v in group], k=SEMANTIC_K)
+        for (i, _), semantic_results in zip(group, results):
+            final_results, seen_urls, _ = staged[i]
+            merge_hits(final_results, seen_urls, semantic_hits(semantic_results))
+
+    for _, _, needs_semantic in staged:
+        search_stats.record(needs_semantic, needed=needs_semantic)
+    return [final_results for final_results, _, _ in staged]
+
+@app.route("/search", methods=["GET"])
+def search():
+    started = time.perf_counter()
+    tenant_id = request.args.get("tenant_id")
+    query = request.args.get("query", "").lower()
+
+    if not tenant_id or not query:
+        return jsonify({"error": "Missing tenant_id or query"}), 400
+
+    vectorstore = vectorstore_cache.get(tenant_id)
+    if vectorstore is None:
+        return jsonify({"error": f"No KB found for tenant {tenant_id}"}), 404
+
+    cached = result_cache.get(tenant_id, query, vectorstore.version)
+    if cached is not None:
+        return jsonify(cached)
+
+    final_results, complete = run_search(vectorstore, query, started)
+    if complete:
+        result_cache.put(tenant_id, query, vectorstore.version, final_results)
     return jsonify(final_results)
 
+@app.route("/search/stream", methods=["GET"])
+def search_stream():
+    """/search as NDJSON, one line per stage: {"stage", "final", "results"}.
+
+    The fuzzy page is sent as soon as it is scored; when the semantic stage
+    runs, a second line carries the merged page (or, past SEARCH_BUDGET_MS,
+    the fuzzy page again as stage "budget"). The last line ("final": true)
+    holds exactly what /search returns.
+    """
+    started = time.perf_counter()
+    tenant_id = request.args.get("tenant_id")
+    query = request.args.get("query", "").lower()
+
+    if not tenant_id or not query:
+        return jsonify({"error": "Missing tenant_id or query"}), 400
+
+    vectorstore = vectorstore_cache.get(tenant_id)
+    if vectorstore is None:
+        return jsonify({"error": f"No KB found for tenant {tenant_id}"}), 404
+
+    def line(stage, final, results):
+        return json.dumps({"stage": stage, "final": final, "results": results}) + "\n"
+
+    def stream():
+        cached = result_cache.get(tenant_id, query, vectorstore.version)
+        if cached is not None:
+            yield line("cached", True, cached)
+            return
+        for stage, final_results, final in search_stages(vectorstore, query, started):
+            yield line(stage, final, final_results)
+        if stage != "budget":
+            result_cache.put(tenant_id, query, vectorstore.version, final_results)
+
+    # No buffering anywhere on the way, or the first line waits for the last
+    return Response(stream(), mimetype="application/x-ndjson",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/search/batch", methods=["POST"])
+def search_batch():
+    """Many searches in one request: {"queries": [{"tenant_id", "query"}, ...]}.
+
+    A top-level "tenant_id" applies to entries without one. "results" holds,
+    per entry and in order, the list /search would return or {"error", "status"}.
+    """
+    data = request.get_json(silent=True) or {}
+    entries = data.get("queries")
+    if not isinstance(entries, list) or not entries:
+        return jsonify({"error": "Missing queries"}), 400
+    if len(entries) > SEARCH_BATCH_MAX:
+        return jsonify({"error": f"At most {SEARCH_BATCH_MAX} queries per batch"}), 400
+
+    results = [None] * len(entries)
+    pending = {}  # (tenant_id, query) -> (vectorstore, entry positions)
+    for pos, entry in enumerate(entries):
+        entry = entry if isinstance(entry, dict) else {}
+        tenant_id = entry.get("tenant_id") or data.get("tenant_id")
+        query = str(entry.get("query", "")).lower()
+        if not tenant_id or not query:
+            results[pos] = {"error": "Missing tenant_id or query", "status": 400}
+            continue
+        if not isinstance(tenant_id, str):
+            results[pos] = {"error": "tenant_id must be a string", "status": 400}
+            continue
+        key = (tenant_id, query)
+        if key in pending:
+            pending[key][1].append(pos)
+            continue
+        vectorstore = vectorstore_cache.get(tenant_id)
+        if vectorstore is None:
+            results[pos] = {"error": f"No KB found for tenant {tenant_id}", "status": 404}
+            continue
+        cached = result_cache.get(tenant_id, query, vectorstore.version)
+        if cached is not None:
+            results[pos] = cached
+            continue
+        pending[key] = (vectorstore, [pos])
+
+    keys = list(pending)
+    searched = run_search_batch([(pending[key][0], key[1]) for key in keys])
+    for (tenant_id, query), final_results in zip(keys, searched):
+        vectorstore, positions = pending[(tenant_id, query)]
+        result_cache.put(tenant_id, query, vectorstore.version, final_results)
+        for pos in positions:
+            results[pos] = final_results
+    return jsonify({"results": results})
+
+# ---------- Step 6: Runtime Stats ----------
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify({
+        "startup": startup_stats(),
+        "worker": worker_stats(),
+        "vectorstore_cache": vectorstore_cache.stats(),
+        "embedding_cache": document_embedder.cache.stats(),
+        "embedding_engine": embedding_engine.stats(),
+        "query_embedding_cache": query_embedder.stats(),
+        "query_batcher": query_batcher.stats(),
+        "result_cache": result_cache.stats(),
+        "search": search_stats.stats(),
+    })
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 10000))
     app.run(host="0.0.0.0", port=port, debug=False)
@@ -0,0 +1,362 @@
+"""Reproducible benchmark of upload and search on synthetic vehicle catalogs.
+
+    python benchmark.py --sizes 1000,10000,100000 --output bench.json
+    python benchmark.py --sizes 1000,10000 --compare bench.json
+
+For each catalog size, a seeded generator writes dealer listings with
+realistic title and description lengths. The app is then driven in-process
+through Flask's test client, in a scratch directory with cold caches:
+
+* upload: the whole catalog (docs/s), then an upsert changing 1% of it;
+* search: a keystroke trace, i.e. every prefix of queries typed by a user
+  (makes, models, variants, typos), timed per request with the result cache
+  off (``RESULT_CACHE_SIZE=0``, unless set) so every keystroke does the work;
+* memory: peak RSS of each phase.
+
+The report is JSON, with the commit and the settings it ran with. With
+``--compare`` the run is checked against an earlier report: latencies, peak
+memory and upload throughput worse by more than ``--tolerance`` fail the
+run (exit status 1). The app reads its usual environment variables, so a
+config is benchmarked by setting them. ``loadtest.py`` measures a running
+server over HTTP instead.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+MAKES = {
+    "Maruti Suzuki": ["Swift", "Baleno", "Dzire", "Brezza", "Ertiga", "Alto", "WagonR", "Ciaz"],
+    "Hyundai": ["Creta", "Venue", "i20", "Verna", "Alcazar", "Grand i10", "Tucson"],
+    "Tata": ["Nexon", "Punch", "Harrier", "Safari", "Altroz", "Tiago", "Tigor"],
+    "Mahindra": ["XUV700", "Scorpio N", "Thar", "XUV300", "Bolero", "Marazzo"],
+    "Kia": ["Seltos", "Sonet", "Carens", "Carnival"],
+    "Toyota": ["Innova Crysta", "Fortuner", "Glanza", "Urban Cruiser Hyryder", "Camry"],
+    "Honda": ["City", "Amaze", "Elevate", "Jazz", "WR-V"],
+    "MG": ["Hector", "Astor", "ZS EV", "Gloster", "Comet EV"],
+    "Skoda": ["Kushaq", "Slavia", "Octavia", "Superb"],
+    "Volkswagen": ["Taigun", "Virtus", "Polo"],
+}
+VARIANTS = ["LXi", "VXi", "ZXi", "ZXi+", "E", "S", "SX", "SX(O)", "XE", "XM", "XZ+", "HTK", "HTX", "GTX+", "Base", "Top"]
+FUELS = ["Petrol", "Diesel", "CNG", "Electric", "Hybrid"]
+TRANSMISSIONS = ["Manual", "Automatic", "AMT", "CVT", "DCT"]
+COLORS = ["Pearl White", "Silver", "Grey", "Black", "Fiery Red", "Blue", "Brown", "Orange"]
+CITIES = ["Delhi", "Mumbai", "Bengaluru", "Pune", "Hyderabad", "Chennai", "Kolkata", "Ahmedabad", "Jaipur", "Lucknow"]
+FEATURES = [
+    "sunroof", "alloy wheels", "touchscreen infotainment", "Android Auto and Apple CarPlay", "rear camera",
+    "cruise control", "ventilated seats", "six airbags", "ABS with EBD", "keyless entry", "push button start",
+    "automatic climate control", "LED headlamps", "wireless charger", "connected car tech", "360 degree camera",
+]
+CONDITION = [
+    "Single owner, company serviced, all records available.",
+    "Second owner, well maintained, new tyres fitted last year.",
+    "Accident free, original paint, insurance valid till next year.",
+    "Dealer certified with a 140-point inspection and one year warranty.",
+    "Driven mostly on highways, no flood damage, non-smoker owner.",
+]
+
+
+def generate_catalog(size: int, seed: int = 0) -> list:
+    """``size`` used-car listings: ~8-word titles, ~60-120 word descriptions."""
+    rng = random.Random(seed)
+    makes = list(MAKES)
+    docs = []
+    for i in range(size):
+        make = rng.choice(makes)
+        model = rng.choice(MAKES[make])
+        variant, fuel, transmission = rng.choice(VARIANTS), rng.choice(FUELS), rng.choice(TRANSMISSIONS)
+        year, km = rng.randint(2012, 2024), rng.randint(3, 150) * 1000
+        color, city = rng.choice(COLORS), rng.choice(CITIES)
+        price = rng.randint(25, 400) / 10
+        features = rng.sample(FEATURES, rng.randint(3, 7))
+        content = (
+            f"{year} {make} {model} {variant} {fuel} {transmission} in {color}, {km:,} km driven, "
+            f"registered in {city}. Asking price Rs {price} lakh, negotiable. "
+            f"Comes with {', '.join(features[:-1])} and {features[-1]}. {rng.choice(CONDITION)} "
+            f"{rng.choice(CONDITION)} Easy finance and exchange available; test drive at our {city} showroom. "
+            f"Listing {i}."
+        )
+        docs.append({
+            "id": f"listing-{i}",
+            "title": f"{year} {make} {model} {variant} {fuel} {transmission}",
+            "url": f"https://dealer.example/{city.lower()}/{model.lower().replace(' ', '-')}-{i}",
+            "content": content,
+        })
+    return docs
+
+
+def keystroke_trace(count: int, seed: int = 0) -> list:
+    """Every prefix (from 2 characters) of ``count`` typed queries, in typing order."""
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(count):
+        make = rng.choice(list(MAKES))
+        model = rng.choice(MAKES[make])
+        query = rng.choice([
+            model,
+            f"{model} {rng.choice(FUELS)}",
+            f"{make} {model}",
+            f"{model} {rng.choice(VARIANTS)} {rng.choice(TRANSMISSIONS)}",
+            f"{rng.choice(COLORS)} {model} {rng.choice(CITIES)}",
+            f"{rng.choice(['used', 'second hand'])} {rng.choice(FUELS)} car with {rng.choice(FEATURES)}",
+        ]).lower()
+        if rng.random() < 0.2:
+            # A typo: one character dropped
+            pos = rng.randrange(1, len(query))
+            query = query[:pos] + query[pos + 1:]
+        queries.extend(query[:n] for n in range(2, len(query) + 1))
+    return queries
+
+
+class PeakMemory:
+    """Peak RSS of a phase, reset between phases where Linux allows it."""
+
+    def __enter__(self):
+        self.resettable = _reset_peak_rss()
+        self.start_bytes = _rss_bytes()
+        return self
+
+    def __exit__(self, *exc):
+        self.peak_bytes = _peak_rss_bytes()
+        self.end_bytes = _rss_bytes()
+
+    def report(self) -> dict:
+        return {
+            "start_mb": round(self.start_bytes / 2**20, 1),
+            "end_mb": round(self.end_bytes / 2**20, 1),
+            # Without a reset this is the process peak so far
+            "peak_mb": round(self.peak_bytes / 2**20, 1),
+            "peak_is_per_phase": self.resettable,
+        }
+
+
+def _reset_peak_rss() -> bool:
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _status_kb(field: str):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _rss_bytes() -> int:
+    kb = _status_kb("VmRSS")
+    return kb * 1024 if kb is not None else _peak_rss_bytes()
+
+
+def _peak_rss_bytes() -> int:
+    kb = _status_kb("VmHWM")
+    if kb is None:
+        # ru_maxrss is in KiB on Linux, bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+    return kb * 1024
+
+
+def percentiles(latencies: list) -> dict:
+    latencies = sorted(latencies)
+    pct = lambda p: round(latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))], 3)
+    return {
+        "mean": round(statistics.fmean(latencies), 3),
+        "p50": pct(50),
+        "p90": pct(90),
+        "p95": pct(95),
+        "p99": pct(99),
+        "max": round(latencies[-1], 3),
+    }
+
+
+def run_size(app, size: int, trace: list, seed: int) -> dict:
+    client = app.app.test_client()
+    tenant_id = f"bench-{size}"
+    docs = generate_catalog(size, seed)
+    result = {"docs": size}
+
+    with PeakMemory() as memory:
+        started = time.perf_counter()
+        response = client.post("/upload", json={"tenant_id": tenant_id, "docs": docs})
+        elapsed = time.perf_counter() - started
+    if response.status_code != 200:
+        raise RuntimeError(f"upload of {size} docs failed: {response.get_json()}")
+    body = response.get_json()
+    result["upload"] = {
+        "seconds": round(elapsed, 3),
+        "docs_per_sec": round(size / elapsed, 1),
+        "embedding_docs_per_sec": round(body["embedding"]["docs_per_sec"], 1),
+        "index": body["index"],
+        "memory": memory.report(),
+    }
+
+    # An upsert touching 1% of the catalog: only those docs are re-embedded
+    rng = random.Random(seed + 1)
+    changed = [dict(d, content=d["content"] + " Price reduced.") for d in rng.sample(docs, max(1, size // 100))]
+    with PeakMemory() as memory:
+        started = time.perf_counter()
+        response = client.post("/upload", json={"tenant_id": tenant_id, "mode": "upsert", "docs": changed})
+        elapsed = time.perf_counter() - started
+    result["upsert"] = {
+        "docs": len(changed),
+        "seconds": round(elapsed, 3),
+        "docs_per_sec": round(len(changed) / elapsed, 1),
+        "changes": response.get_json()["changes"],
+        "memory": memory.report(),
+    }
+
+    before = client.get("/stats").get_json()["search"]
+    latencies = []
+    with PeakMemory() as memory:
+        for query in trace:
+            started = time.perf_counter()
+            response = client.get("/search", query_string={"tenant_id": tenant_id, "query": query})
+            latencies.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                raise RuntimeError(f"search {query!r} failed: {response.get_json()}")
+    after = client.get("/stats").get_json()["search"]
+    searches = after["searches"] - before["searches"]
+    result["search"] = {
+        "queries": len(trace),
+        "latency_ms": percentiles(latencies),
+        "qps": round(len(latencies) / (sum(latencies) / 1000), 1),
+        "semantic_skip_rate": round((after["semantic_skipped"] - before["semantic_skipped"]) / searches, 3)
+        if searches else None,
+        "memory": memory.report(),
+    }
+    return result
+
+
+# (path in a size's result, True if higher is better)
+COMPARED = [
+    (("upload", "docs_per_sec"), True),
+    (("upsert", "seconds"), False),
+    (("search", "latency_ms", "p50"), False),
+    (("search", "latency_ms", "p95"), False),
+    (("search", "latency_ms", "p99"), False),
+    (("upload", "memory", "peak_mb"), False),
+    (("search", "memory", "peak_mb"), False),
+]
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """Metrics of ``report`` worse than ``baseline`` by more than ``tolerance`` (a fraction)."""
+    base_runs = {run["docs"]: run for run in baseline["runs"]}
+    regressions = []
+    for run in report["runs"]:
+        base = base_runs.get(run["docs"])
+        if base is None:
+            continue
+        for path, higher_is_better in COMPARED:
+            new, old = _get(run, path), _get(base, path)
+            if new is None or not old:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            line = {"docs": run["docs"], "metric": ".".join(path), "baseline": old, "current": new,
+                    "change": round(change, 3)}
+            print(json.dumps(line), file=sys.stderr)
+            if worse > tolerance:
+                regressions.append(line)
+    return regressions
+
+
+def _get(run: dict, path: tuple):
+    for key in path:
+        if not isinstance(run, dict) or key not in run:
+            return None
+        run = run[key]
+    return run
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", default="1000,10000", help="comma-separated catalog sizes")
+    parser.add_argument("--queries", type=int, default=50, help="typed queries in the keystroke trace")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here (default: stdout)")
+    parser.add_argument("--compare", help="earlier report to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    parser.add_argument("--workdir", help="scratch directory for KBs and caches (default: a new temp dir)")
+    args = parser.parse_args()
+    # Relative to where the benchmark was started, not the scratch directory
+    for name in ("output", "compare", "workdir"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    # Cold, isolated caches unless the caller chose otherwise; read when app is imported
+    workdir = args.workdir or tempfile.mkdtemp(prefix="kb-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    os.environ.setdefault("RESULT_CACHE_SIZE", "0")
+    os.environ.setdefault("EMBEDDING_CACHE_DIR", os.path.join(workdir, "embedding_cache"))
+    os.environ.setdefault("UPLOAD_JOBS_DIR", os.path.join(workdir, "upload_jobs"))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+    with PeakMemory() as memory:
+        started = time.perf_counter()
+        import app
+        app.embedding_model.get()
+        import_seconds = time.perf_counter() - started
+
+    trace = keystroke_trace(args.queries, args.seed)
+    report = {
+        "commit": _commit(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "settings": {
+            "seed": args.seed,
+            "trace_queries": args.queries,
+            "env": {k: v for k, v in sorted(os.environ.items())
+                    if k.startswith(("EMBEDDING_", "FAISS_", "POOL_", "SEARCH_", "PARALLEL_", "RESULT_CACHE",
+                                     "QUERY_", "FUZZY_", "OMP_", "ONNX_"))},
+        },
+        "startup": {"seconds": round(import_seconds, 3), "memory": memory.report()},
+        "runs": [run_size(app, int(size), trace, args.seed) for size in args.sizes.split(",")],
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) over {args.tolerance:.0%}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
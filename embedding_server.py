@@ -0,0 +1,250 @@
+"""Out-of-process embedding server for the web workers.
+
+    python embedding_server.py --socket /tmp/embeddings.sock --workers 2
+    EMBEDDING_SERVER=/tmp/embeddings.sock gunicorn -c gunicorn.conf.py app:app
+
+The server loads the model once, then forks ``--workers`` processes that
+share its weights copy-on-write and accept on the same Unix socket; each runs
+one forward pass at a time. Web processes hold no model: ``RemoteEmbeddingModel``
+sends them batches of texts (queries already coalesced by ``QueryBatcher``,
+upload batches from ``EmbeddingEngine``), so HTTP concurrency and model
+concurrency are sized independently.
+
+Model options default to the same environment variables as app.py. On
+connect, the client checks that the server runs the model its embedding
+caches were built with.
+
+Frames are a 4-byte big-endian length and a payload. A request is one JSON
+frame, ``{"op": "info"}`` or ``{"op": "embed", "texts": [...]}``. The reply is
+a JSON frame (``{"model"}``, ``{"rows", "dim"}`` or ``{"error"}``). For
+embeds it is followed by a frame of ``rows x dim`` float32 vectors.
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+import numpy as np
+
+from embeddings import load_embedding_model, model_cache_name
+
+_LENGTH = struct.Struct(">I")
+
+
+def send_frame(sock: socket.socket, payload: bytes):
+    sock.sendall(_LENGTH.pack(len(payload)) + payload)
+
+
+def recv_frame(sock: socket.socket) -> bytes:
+    (length,) = _LENGTH.unpack(_recv_exact(sock, _LENGTH.size))
+    return _recv_exact(sock, length)
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    buf = bytearray(size)
+    view = memoryview(buf)
+    while view:
+        n = sock.recv_into(view)
+        if not n:
+            raise ConnectionError("embedding server connection closed")
+        view = view[n:]
+    return bytes(buf)
+
+
+class RemoteEmbeddingModel:
+    """Client for ``embedding_server.py``, in place of ``LazyEmbeddingModel``.
+
+    Each thread keeps one connection to the server (reopened after a fork or
+    a dropped connection). ``get()`` waits up to ``connect_timeout`` seconds
+    for the server to come up, e.g. when both start with the container.
+    """
+
+    def __init__(self, socket_path: str, model_name: str = None, connect_timeout: float = 30.0):
+        self.socket_path = socket_path
+        self.model_name = model_name
+        self.connect_timeout = connect_timeout
+        self.load_seconds = None
+        self.server_info = None
+        self._local = threading.local()
+
+    @property
+    def loaded(self) -> bool:
+        return self.server_info is not None
+
+    def get(self):
+        if self.server_info is None:
+            started = time.perf_counter()
+            deadline = time.monotonic() + self.connect_timeout
+            while True:
+                try:
+                    info = self._request({"op": "info"})[0]
+                    break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        raise
+                    time.sleep(0.2)
+            if self.model_name and info["model"] != self.model_name:
+                raise RuntimeError(
+                    f"Embedding server at {self.socket_path} runs {info['model']}, expected {self.model_name}"
+                )
+            self.load_seconds = time.perf_counter() - started
+            self.server_info = info
+        return self
+
+    def embed_documents(self, texts: list) -> np.ndarray:
+        self.get()
+        return self._request({"op": "embed", "texts": list(texts)})[1]
+
+    def embed_query(self, text: str) -> np.ndarray:
+        return self.embed_documents([text])[0]
+
+    def _request(self, message: dict):
+        # One retry on a fresh connection: the server may have restarted
+        for attempt in (0, 1):
+            sock = self._connection()
+            try:
+                send_frame(sock, json.dumps(message).encode())
+                header = json.loads(recv_frame(sock))
+                vectors = None
+                if "rows" in header:
+                    vectors = np.frombuffer(recv_frame(sock), dtype=np.float32).reshape(header["rows"], header["dim"])
+                break
+            except OSError:
+                self._close()
+                if attempt:
+                    raise
+        if "error" in header:
+            raise RuntimeError(f"Embedding server error: {header['error']}")
+        return header, vectors
+
+    def _connection(self) -> socket.socket:
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            # Inherited across fork: the parent still owns that socket
+            local.sock = None
+            local.pid = os.getpid()
+        if local.sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.socket_path)
+            except OSError:
+                sock.close()
+                raise
+            local.sock = sock
+        return local.sock
+
+    def _close(self):
+        if getattr(self._local, "sock", None) is not None:
+            self._local.sock.close()
+            self._local.sock = None
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        while True:
+            try:
+                message = json.loads(recv_frame(self.request))
+            except ConnectionError:
+                return
+            if message.get("op") == "info":
+                send_frame(self.request, json.dumps(server.info).encode())
+                continue
+            texts = message["texts"]
+            try:
+                if texts:
+                    with server.model_lock:
+                        vectors = np.asarray(server.model.embed_documents(texts), dtype=np.float32)
+                else:
+                    vectors = np.zeros((0, 0), dtype=np.float32)
+            except Exception as e:
+                send_frame(self.request, json.dumps({"error": repr(e)}).encode())
+                continue
+            send_frame(self.request, json.dumps({"rows": len(vectors), "dim": vectors.shape[1]}).encode())
+            send_frame(self.request, np.ascontiguousarray(vectors).tobytes())
+
+
+class EmbeddingServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, model, model_name: str):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, _Handler)
+        self.model = model
+        # Connections are threads; the model runs one batch at a time per process
+        self.model_lock = threading.Lock()
+        self.info = {"model": model_name}
+
+
+def serve(socket_path: str, model_spec: dict, workers: int = 1):
+    model = load_embedding_model(**model_spec)
+    server = EmbeddingServer(socket_path, model, model_cache_name(model_spec))
+
+    # Fork after loading (weights shared copy-on-write) but before any forward
+    # pass: an OpenMP pool started in the parent does not survive the fork.
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            # Stopped by the parent's SIGTERM; never return into the parent's code
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                # Already stopped and reaped, e.g. on a second SIGTERM
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def main():
+    env = os.environ.get
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--socket", default=env("EMBEDDING_SERVER", "/tmp/embeddings.sock"))
+    parser.add_argument("--workers", type=int, default=int(env("EMBEDDING_SERVER_WORKERS", 1)))
+    parser.add_argument("--backend", default=env("EMBEDDING_BACKEND", "torch"))
+    parser.add_argument("--model", default="sentence-transformers/paraphrase-MiniLM-L6-v2")
+    parser.add_argument("--model-path", default=env("EMBEDDING_MODEL_PATH"))
+    parser.add_argument("--onnx-dir", default=env("ONNX_MODEL_DIR"))
+    parser.add_argument("--quantized", action="store_true", default=env("ONNX_QUANTIZED") == "1")
+    parser.add_argument("--threads", type=int, default=int(env("EMBEDDING_THREADS", 0)),
+                        help="threads per worker (default: the backend's own)")
+    parser.add_argument("--batch-size", type=int, default=int(env("EMBEDDING_BATCH_SIZE", 32)))
+    args = parser.parse_args()
+
+    serve(args.socket, {
+        "backend": args.backend,
+        "model_name": args.model,
+        "batch_size": args.batch_size,
+        "onnx_dir": args.onnx_dir,
+        "quantized": args.quantized,
+        "threads": args.threads,
+        "model_path": args.model_path,
+    }, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,526 @@
+"""Embedding helpers shared by the upload and search paths."""
+import fcntl
+import hashlib
+import multiprocessing
+import os
+import queue
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import numpy as np
+
+_WHITESPACE = re.compile(r"\s+")
+_DIGEST_SIZE = hashlib.sha1().digest_size
+
+
+def load_embedding_model(backend: str = "torch", model_name: str = None, batch_size: int = 32,
+                         onnx_dir: str = None, quantized: bool = False, threads: int = 0,
+                         model_path: str = None):
+    """Build the embedding model for ``backend`` ("torch" or "onnx").
+
+    ``model_path`` is a local copy of ``model_name`` (e.g. baked into the
+    image); when set, the torch backend loads from it instead of the Hub.
+    """
+    if backend == "onnx":
+        from onnx_embeddings import OnnxEmbeddings
+
+        return OnnxEmbeddings(onnx_dir, quantized=quantized, threads=threads, batch_size=batch_size)
+    if backend != "torch":
+        raise ValueError(f"Unknown embedding backend {backend}")
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    if threads:
+        set_torch_threads(threads)
+    return HuggingFaceEmbeddings(model_name=model_path or model_name, encode_kwargs={"batch_size": batch_size})
+
+
+class LazyEmbeddingModel:
+    """Builds the model on first use, keeping torch and transformers out of startup."""
+
+    def __init__(self, spec: dict):
+        self.spec = spec
+        self.load_seconds = None
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    def get(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    started = time.perf_counter()
+                    model = load_embedding_model(**self.spec)
+                    self.load_seconds = time.perf_counter() - started
+                    self._model = model
+        return self._model
+
+    def embed_documents(self, texts: list):
+        return self.get().embed_documents(texts)
+
+    def embed_query(self, text: str):
+        return self.get().embed_query(text)
+
+
+def model_cache_name(spec: dict) -> str:
+    """Name under which a model's vectors are cached; backends that do not
+    produce identical vectors must not share cache entries."""
+    if spec.get("backend", "torch") == "torch":
+        return spec["model_name"]
+    return f"{spec['model_name']}@onnx{'-int8' if spec.get('quantized') else ''}"
+
+
+def normalize_text(text: str) -> str:
+    # The WordPiece tokenizer ignores whitespace runs, so texts that differ only
+    # there embed identically and can share a cache entry.
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFC", text)).strip()
+
+
+class EmbeddingEngine:
+    """Batched document embedding for large uploads.
+
+    Texts are sorted by length and cut into batches whose padded size
+    (``count * longest``, in estimated tokens) stays under
+    ``max_batch_tokens``, so short listings are encoded in wide batches and
+    long ones do not blow up padding. Uploads of at least
+    ``process_threshold`` texts are sharded across a pool of ``processes``
+    workers, each building its own model from ``model_spec`` (the arguments
+    of ``load_embedding_model``); smaller ones run in the calling thread.
+    """
+
+    def __init__(self, model, model_spec: dict, batch_size: int = 32, max_batch_tokens: int = 4096,
+                 processes: int = 0, process_threshold: int = 5000, max_seq_length: int = 128):
+        self.model = model
+        self.model_spec = model_spec
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.processes = processes
+        self.process_threshold = process_threshold
+        self.max_seq_length = max_seq_length
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.docs = 0
+        self.seconds = 0.0
+
+    def embed_documents(self, texts: list, progress=None) -> np.ndarray:
+        """Embed ``texts``; ``progress(n)`` is called as each batch of n texts completes."""
+        started = time.perf_counter()
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+        batches = self._batches([texts[i] for i in order])
+
+        if self.processes > 1 and len(texts) >= self.process_threshold:
+            results = self._get_pool().map(_embed_in_worker, batches)
+        else:
+            results = (self.model.embed_documents(batch) for batch in batches)
+
+        out = None
+        row = 0
+        for vectors in results:
+            vectors = np.asarray(vectors, dtype=np.float32)
+            if out is None:
+                out = np.empty((len(texts), vectors.shape[1]), dtype=np.float32)
+            out[order[row:row + len(vectors)]] = vectors
+            row += len(vectors)
+            if progress is not None:
+                progress(len(vectors))
+
+        with self._stats_lock:
+            self.docs += len(texts)
+            self.seconds += time.perf_counter() - started
+        return out if out is not None else np.zeros((0, 0), dtype=np.float32)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "docs": self.docs,
+                "seconds": round(self.seconds, 3),
+                "docs_per_sec": self.docs / self.seconds if self.seconds else 0.0,
+                "batch_size": self.batch_size,
+                "max_batch_tokens": self.max_batch_tokens,
+                "backend": self.model_spec.get("backend", "torch"),
+                "threads": self.model_spec.get("threads", 0),
+                "processes": self.processes,
+            }
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+    def _batches(self, texts: list) -> list:
+        # `texts` is sorted longest first, so a batch's first text sets its padding
+        batches = []
+        start = 0
+        while start < len(texts):
+            longest = self._estimate_tokens(texts[start])
+            size = max(1, min(self.batch_size, self.max_batch_tokens // longest))
+            batches.append(texts[start:start + size])
+            start += size
+        return batches
+
+    def _estimate_tokens(self, text: str) -> int:
+        # ~4 characters per WordPiece token, plus [CLS]/[SEP]; the model truncates
+        return min(len(text) // 4 + 2, self.max_seq_length)
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                # spawn: forking a process that already holds torch threads is unsafe
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(dict(self.model_spec, threads=self.model_spec.get("threads") or 1),),
+                )
+            return self._pool
+
+
+def set_torch_threads(threads: int):
+    import torch
+
+    torch.set_num_threads(threads)
+
+
+_worker_model = None
+
+
+def _init_worker(model_spec: dict):
+    global _worker_model
+    _worker_model = load_embedding_model(**model_spec)
+
+
+def _embed_in_worker(texts: list) -> np.ndarray:
+    return np.asarray(_worker_model.embed_documents(texts), dtype=np.float32)
+
+
+class EmbeddingCache:
+    """Persistent, append-only cache of document embeddings for one model.
+
+    Lives in ``<root>/<model slug>/`` as ``vectors.f32`` (a float32 matrix,
+    one row per entry), ``keys.bin`` (the SHA-1 of each row's normalized
+    text, 20 bytes per row, in the same order) and ``dim`` (the row width,
+    written before the first row). Keys are loaded into a dict on
+    open and vectors are memory-mapped. Several processes may share a cache:
+    appends take an exclusive flock and first pick up rows written by others.
+    """
+
+    def __init__(self, root: str, model_name: str):
+        self.model_name = model_name
+        self.path = os.path.join(root, re.sub(r"[^A-Za-z0-9_.-]+", "__", model_name))
+        os.makedirs(self.path, exist_ok=True)
+        self._keys_path = os.path.join(self.path, "keys.bin")
+        self._vectors_path = os.path.join(self.path, "vectors.f32")
+        self._dim_path = os.path.join(self.path, "dim")
+        self._lock_path = os.path.join(self.path, ".lock")
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._dim = None
+        self._vectors = None
+        self.hits = 0
+        self.misses = 0
+        with self._lock:
+            self._sync()
+
+    def __len__(self):
+        return len(self._rows)
+
+    @staticmethod
+    def key(text: str) -> bytes:
+        return hashlib.sha1(normalize_text(text).encode("utf-8")).digest()
+
+    def lookup(self, keys: list) -> dict:
+        """Map each cached key to its vector; keys not in the cache are omitted."""
+        with self._lock:
+            self._sync()
+            found = {k: self._vectors[self._rows[k]] for k in keys if k in self._rows}
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+            return found
+
+    def add(self, keys: list, vectors: np.ndarray):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self._lock, open(self._lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._sync()
+            fresh = [i for i, k in enumerate(keys) if k not in self._rows]
+            if not fresh:
+                return
+            if self._dim is None:
+                self._write_dim(vectors.shape[1])
+            if vectors.shape[1] != self._dim:
+                raise ValueError(f"Vectors of width {vectors.shape[1]} for a cache of width {self._dim}")
+            # Drop any rows a crashed writer appended without their keys, so
+            # vector row i always belongs to key i.
+            with open(self._vectors_path, "ab") as f:
+                f.truncate(len(self._rows) * vectors.shape[1] * 4)
+                f.write(vectors[fresh].tobytes())
+            with open(self._keys_path, "ab") as f:
+                f.truncate(len(self._rows) * _DIGEST_SIZE)
+                f.write(b"".join(keys[i] for i in fresh))
+            self._sync()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "model": self.model_name,
+            "entries": len(self._rows),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _sync(self):
+        """Pick up rows appended since the last sync, by this or another process."""
+        try:
+            size = os.path.getsize(self._keys_path)
+        except FileNotFoundError:
+            return
+        count = size // _DIGEST_SIZE
+        if count == len(self._rows):
+            return
+        with open(self._keys_path, "rb") as f:
+            f.seek(len(self._rows) * _DIGEST_SIZE)
+            data = f.read((count - len(self._rows)) * _DIGEST_SIZE)
+        if self._dim is None:
+            self._dim = self._read_dim(count)
+        for i in range(0, len(data), _DIGEST_SIZE):
+            self._rows[data[i:i + _DIGEST_SIZE]] = len(self._rows)
+        # Only the rows that have keys are mapped; bytes past them are ignored
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(count, self._dim))
+
+    def _read_dim(self, count: int) -> int:
+        try:
+            with open(self._dim_path) as f:
+                return int(f.read())
+        except FileNotFoundError:
+            pass
+        # Caches written before the width was stored: only trusted when the
+        # vectors file holds exactly one row per key, i.e. no orphan rows
+        size = os.path.getsize(self._vectors_path)
+        if size % (4 * count):
+            raise RuntimeError(f"Cannot tell the vector width of {self.path}; delete it to rebuild")
+        dim = size // 4 // count
+        self._write_dim(dim)
+        return dim
+
+    def _write_dim(self, dim: int):
+        tmp = f"{self._dim_path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(str(dim))
+        os.replace(tmp, self._dim_path)
+        self._dim = dim
+
+
+class CachedEmbedder:
+    """Embeds documents through ``engine``, reusing vectors from ``cache``."""
+
+    def __init__(self, engine: EmbeddingEngine, cache: EmbeddingCache):
+        self.engine = engine
+        self.cache = cache
+
+    def embed_documents(self, texts: list, progress=None, counts: dict = None) -> np.ndarray:
+        """Embed ``texts``; ``counts``, if given, is filled with how many were
+        served from the cache ("cached") and run through the model ("embedded")."""
+        keys = [EmbeddingCache.key(t) for t in texts]
+        found = self.cache.lookup(keys)
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = normalize_text(text)
+        if counts is not None:
+            counts.update(cached=len(texts) - len(missing), embedded=len(missing))
+        if progress is not None:
+            progress(len(texts) - len(missing))
+        if missing:
+            vectors = np.asarray(self.engine.embed_documents(list(missing.values()), progress=progress), dtype=np.float32)
+            self.cache.add(list(missing), vectors)
+            found.update(zip(missing, vectors))
+
+        if not keys:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack([found[k] for k in keys])
+
+
+class QueryBatcher:
+    """Coalesces concurrent query encodes into one forward pass.
+
+    Callers block in ``embed_query`` while a single background thread
+    collects requests until ``max_batch`` are queued or ``max_wait_ms`` has
+    passed since the first one, then embeds them together and hands each
+    caller its own vector. A lone request waits at most ``max_wait_ms``.
+    """
+
+    def __init__(self, model, max_batch: int = 32, max_wait_ms: float = 2.0):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread_pid = None
+        self.batches = 0
+        self.items = 0
+
+    def embed_query(self, text: str) -> np.ndarray:
+        self._ensure_thread()
+        future = Future()
+        self._queue.put((text, future))
+        return future.result()
+
+    def embed_queries(self, texts: list) -> np.ndarray:
+        """Embed many queries at once, in the caller's thread: already one batch."""
+        vectors = np.asarray(self.model.embed_documents(texts), dtype=np.float32)
+        with self._lock:
+            self.batches += 1
+            self.items += len(texts)
+        return vectors
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": self.items / self.batches if self.batches else 0.0,
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000,
+        }
+
+    def _ensure_thread(self):
+        # Started lazily, and again in a forked child, which inherits no threads
+        if self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread_pid != os.getpid():
+                self._queue = queue.Queue()
+                threading.Thread(target=self._run, name="query-batcher", daemon=True).start()
+                self._thread_pid = os.getpid()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            self._process(batch)
+
+    def _process(self, batch: list):
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            vectors = np.asarray(self.model.embed_documents(texts), dtype=np.float32)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        # Rows are copied so a cached vector does not keep its whole batch alive
+        by_text = {text: vector.copy() for text, vector in zip(texts, vectors)}
+        for text, future in batch:
+            future.set_result(by_text[text])
+        with self._lock:
+            self.batches += 1
+            self.items += len(batch)
+
+
+class QueryEmbeddingCache:
+    """Process-wide LRU of query vectors, shared by every tenant.
+
+    Keyed by normalized query text for a single model. With ``path`` set, the
+    cache is loaded from an ``.npz`` snapshot at start and written back by
+    ``save()``, so a restarted worker starts warm.
+    """
+
+    def __init__(self, model, model_name: str, max_entries: int = 50000, path: str = None):
+        self.model = model
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.path = path
+        self._entries = OrderedDict()  # normalized query -> read-only float32 vector
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            self._load()
+
+    def embed_query(self, text: str) -> np.ndarray:
+        key = normalize_text(text)
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return vector
+            self.misses += 1
+        vector = np.array(self.model.embed_query(key), dtype=np.float32)
+        self.put(key, vector)
+        return vector
+
+    def embed_queries(self, texts: list) -> list:
+        """``embed_query`` for many texts; the misses are embedded in one pass."""
+        keys = [normalize_text(text) for text in texts]
+        found = {}
+        with self._lock:
+            for key in keys:
+                vector = self._entries.get(key)
+                if vector is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    found[key] = vector
+                else:
+                    self.misses += 1
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        if missing:
+            for key, vector in zip(missing, self.model.embed_queries(missing)):
+                vector = np.array(vector, dtype=np.float32)
+                self.put(key, vector)
+                found[key] = vector
+        return [found[key] for key in keys]
+
+    def put(self, key: str, vector: np.ndarray):
+        vector.setflags(write=False)
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            keys = list(self._entries)
+            vectors = list(self._entries.values())
+        if not keys:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp, model=np.array(self.model_name), keys=np.array(keys), vectors=np.stack(vectors))
+        os.replace(tmp, self.path)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _load(self):
+        with np.load(self.path, allow_pickle=False) as snapshot:
+            if str(snapshot["model"]) != self.model_name:
+                return
+            keys = snapshot["keys"].tolist()
+            vectors = snapshot["vectors"]
+        for key, vector in zip(keys[-self.max_entries:], vectors[-self.max_entries:]):
+            self.put(key, np.array(vector, dtype=np.float32))
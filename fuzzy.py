@@ -0,0 +1,322 @@
+"""Lexical (fuzzy) matching over a tenant's titles and contents."""
+import os
+
+import numpy as np
+from rapidfuzz import fuzz, process
+
+SNIPPET_CHARS = 200
+SCORE_CUTOFF = 80
+# Texts are indexed in chunks to bound the temporary arrays on large KBs
+_INDEX_CHUNK_DOCS = 4096
+
+
+def max_partial_ratio(query_len: int, shared: int) -> float:
+    """Upper bound on ``partial_ratio`` for a text sharing ``shared`` query bigrams.
+
+    ``shared`` counts the query's bigram positions whose bigram occurs anywhere
+    in a text at least as long as the query. In the best alignment, each
+    unmatched query character breaks at most two query bigrams and each
+    unmatched text character at most one, so ``K = query_len - 1 - shared``
+    bigrams need at least ``K / 2`` unmatched query characters. Then the score
+    ``200 * matched / (query_len + window_len)`` is at most
+    ``200 * (2L - K) / (4L - K)``.
+    """
+    k = max(query_len - 1 - shared, 0)
+    return 200 * (2 * query_len - k) / (4 * query_len - k)
+
+
+class BigramIndex:
+    """Character-bigram inverted index over one lowercased text field.
+
+    Used to pick the rows worth scoring against a query. Bigrams, not
+    trigrams: at an 80% cutoff each edit can break up to three trigrams,
+    which leaves no count bound at typical query lengths, but with bigrams a
+    row needs ``3 * shared >= len(query) - 3`` (see ``max_partial_ratio``).
+    Queries of up to three characters are covered exactly instead (see
+    ``_short_query_codes``). Rows shorter than the query make the query the
+    longer string in ``partial_ratio``, so they are always kept; rows
+    containing NUL are stored with length 0 for the same effect.
+
+    Stored as sorted int64 bigram codes (``a << 21 | b``), offsets into a
+    postings array of uint32 rows, and per-row text lengths.
+    """
+
+    FILES = ("bigram_keys", "bigram_offsets", "bigram_rows", "lengths")
+
+    def __init__(self, keys, offsets, rows, lengths):
+        self.keys = keys
+        self.offsets = offsets
+        self.rows = rows
+        self.lengths = lengths
+
+    @property
+    def nbytes(self) -> int:
+        return self.keys.nbytes + self.offsets.nbytes + self.rows.nbytes + self.lengths.nbytes
+
+    @classmethod
+    def build(cls, texts: list) -> "BigramIndex":
+        lengths = _text_lengths(texts)
+        pair_codes = []
+        pair_rows = []
+        for start in range(0, len(texts), _INDEX_CHUNK_DOCS):
+            codes, rows = _bigram_pairs(texts[start:start + _INDEX_CHUNK_DOCS])
+            pair_codes.append(codes)
+            pair_rows.append(rows + start)
+
+        codes = np.concatenate(pair_codes) if pair_codes else np.zeros(0, dtype=np.int64)
+        rows = np.concatenate(pair_rows) if pair_rows else np.zeros(0, dtype=np.int64)
+        order = np.lexsort((rows, codes))
+        codes = codes[order]
+        keys, starts = np.unique(codes, return_index=True)
+        offsets = np.append(starts, len(codes)).astype(np.int64)
+        return cls(keys, offsets, rows[order].astype(np.uint32), lengths)
+
+    def patched(self, kept, count: int, changed, texts: list) -> "BigramIndex":
+        """This index after an update that keeps rows ``kept`` (ascending) as
+        rows ``0..len(kept)-1`` and ends with ``count`` rows.
+
+        ``changed`` are the new rows (ascending, all appended ones included)
+        whose ``texts`` are indexed afresh. The surviving postings are already
+        in order, so the few new ones are merged in rather than every row
+        being re-tokenized and sorted.
+        """
+        new_row = np.full(len(self.lengths), -1, dtype=np.int64)
+        new_row[kept] = np.arange(len(kept))
+        stale = np.zeros(count, dtype=bool)
+        stale[changed] = True
+        codes = np.repeat(np.asarray(self.keys), np.diff(self.offsets))
+        rows = new_row[self.rows]
+        live = rows >= 0
+        live[live] = ~stale[rows[live]]
+        codes = codes[live]
+        rows = rows[live]
+
+        add_codes, add_rows = _bigram_pairs(texts)
+        add_rows = np.asarray(changed, dtype=np.int64)[add_rows]
+        # Sort and merge (code, row) pairs as one integer each; codes take 42 bits
+        shift = max(count, 1).bit_length()
+        if len(add_codes) and shift > 21:
+            codes = np.concatenate([codes, add_codes])
+            rows = np.concatenate([rows, add_rows])
+            order = np.lexsort((rows, codes))
+            codes = codes[order]
+            rows = rows[order]
+        elif len(add_codes):
+            old = (codes << shift) | rows
+            new = np.sort((add_codes << shift) | add_rows)
+            merged = np.insert(old, np.searchsorted(old, new), new)
+            codes = merged >> shift
+            rows = merged & ((1 << shift) - 1)
+
+        starts = np.flatnonzero(np.diff(codes, prepend=-1)) if len(codes) else np.zeros(0, dtype=np.int64)
+        lengths = np.zeros(count, dtype=np.int32)
+        lengths[:len(kept)] = self.lengths[kept]
+        lengths[changed] = _text_lengths(texts)
+        return BigramIndex(
+            codes[starts], np.append(starts, len(codes)).astype(np.int64), rows.astype(np.uint32), lengths
+        )
+
+    @classmethod
+    def load(cls, path: str, field: str) -> "BigramIndex":
+        return cls(*(np.load(os.path.join(path, f"{field}.{name}.npy"), mmap_mode="r") for name in cls.FILES))
+
+    def save(self, path: str, field: str):
+        for name, array in zip(self.FILES, (self.keys, self.offsets, self.rows, self.lengths)):
+            np.save(os.path.join(path, f"{field}.{name}.npy"), array)
+
+    def candidates(self, query: str, start: int = 0, stop: int = None):
+        """Rows that can score at least SCORE_CUTOFF against ``query``; None means all.
+
+        Only rows ``start <= row < stop`` are considered, numbered from ``start``.
+        """
+        query_len = len(query)
+        if not query_len or "\0" in query:
+            return None
+
+        stop = len(self.lengths) if stop is None else stop
+        lengths = self.lengths[start:stop]
+        cps = _code_points(query)
+        if query_len <= 3:
+            codes = _short_query_codes(cps, self.keys)
+            slices = self._postings(np.searchsorted(self.keys, codes).tolist(), start, stop)
+            hit = np.zeros(len(lengths), dtype=bool)
+            if slices:
+                hit[np.concatenate(slices)] = True
+            return np.flatnonzero(hit | (lengths <= query_len))
+
+        needed = query_len - 3  # 3 * shared must reach this
+        codes, counts = np.unique((cps[:-1] << 21) | cps[1:], return_counts=True)
+        pos = np.searchsorted(self.keys, codes)
+        pos[pos == len(self.keys)] = 0
+        present = self.keys[pos] == codes if len(self.keys) else np.zeros(len(codes), dtype=bool)
+
+        slices = self._postings(pos[present].tolist(), start, stop)
+        weights = [np.full(len(rows), count) for rows, count in zip(slices, counts[present])]
+        shared = np.zeros(len(lengths), dtype=np.int64)
+        if slices:
+            shared = np.bincount(
+                np.concatenate(slices), weights=np.concatenate(weights), minlength=len(lengths)
+            )
+        return np.flatnonzero((3 * shared >= needed) | (lengths < query_len))
+
+    def _postings(self, positions: list, start: int, stop: int) -> list:
+        """Rows ``start <= row < stop`` of the postings of ``positions``, numbered from ``start``."""
+        slices = []
+        for p in positions:
+            rows = self.rows[self.offsets[p]:self.offsets[p + 1]]
+            if start or stop < len(self.lengths):
+                # Postings are sorted by row
+                rows = rows[np.searchsorted(rows, start):np.searchsorted(rows, stop)].astype(np.int64) - start
+            slices.append(rows)
+        return slices
+
+
+def _short_query_codes(cps: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    """Indexed bigrams of which a text longer than a 1-3 character query must
+    hold one to reach the cutoff.
+
+    ``partial_ratio`` slides query-length windows over the text, plus shorter
+    ones at both ends; a window scores ``200 * LCS / (query_len + window_len)``.
+    At an 80% cutoff a full window must equal the query and an end window must
+    be two characters forming a subsequence of a three-character query. So a
+    single character must occur in the text (in some bigram, as the text has
+    two or more), two characters must occur as that bigram, and three need one
+    of ``ab``, ``bc`` or ``ac``. Texts of the query's length are matched both
+    ways round and are left to the caller.
+    """
+    if len(cps) == 1:
+        return keys[((keys >> 21) == cps[0]) | ((keys & ((1 << 21) - 1)) == cps[0])]
+    if len(cps) == 2:
+        codes = np.array([cps[0] << 21 | cps[1]])
+    else:
+        codes = np.unique([cps[0] << 21 | cps[1], cps[1] << 21 | cps[2], cps[0] << 21 | cps[2]])
+    return codes[np.isin(codes, keys)]
+
+
+def _text_lengths(texts: list) -> np.ndarray:
+    return np.array([0 if "\0" in t else len(t) for t in texts], dtype=np.int32)
+
+
+def _code_points(text: str) -> np.ndarray:
+    return np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.int64)
+
+
+def _bigram_pairs(texts: list):
+    """Distinct (bigram code, row) pairs for a chunk of texts."""
+    if not texts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    # NUL separates texts so no bigram spans two rows; bigrams touching it are
+    # dropped, and queries containing NUL skip the prefilter.
+    cps = _code_points("\0".join(texts))
+    lengths = np.array([len(t) for t in texts], dtype=np.int64)
+    row_of = np.repeat(np.arange(len(texts)), lengths + 1)[:len(cps)]
+    valid = (cps[:-1] != 0) & (cps[1:] != 0)
+    codes = ((cps[:-1] << 21) | cps[1:])[valid]
+    rows = row_of[:-1][valid]
+    order = np.lexsort((codes, rows))
+    codes = codes[order]
+    rows = rows[order]
+    keep = np.ones(len(codes), dtype=bool)
+    keep[1:] = (codes[1:] != codes[:-1]) | (rows[1:] != rows[:-1])
+    return codes[keep], rows[keep]
+
+
+class FuzzyCorpus:
+    """Everything the fuzzy stage reads for one KB version, left in its files.
+
+    ``docs`` is the version's column store (``get(column, row)`` and
+    ``take(column, rows)``): queries are matched against its ``title_lower``
+    and ``content_lower`` columns, or with ``lowered=False`` against ``title``
+    and ``content`` lowercased on the fly, and hits return its title, url and
+    a snippet of the content. Only the rows the per-field bigram indexes keep
+    are decoded, so the corpus holds no strings between queries and workers
+    share its pages. ``start``/``stop`` restrict it to a range of the rows
+    (a pooled tenant's), numbered from ``start``.
+    """
+
+    def __init__(self, docs, title_index: BigramIndex, content_index: BigramIndex, lowered: bool = True,
+                 start: int = 0, stop: int = None):
+        self.docs = docs
+        self.title_index = title_index
+        self.content_index = content_index
+        self.lowered = lowered
+        self.start = start
+        self.stop = docs.count if stop is None else stop
+        self.nbytes = title_index.nbytes + content_index.nbytes
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def candidates(self, query: str):
+        """Rows that can be hits for ``query``, per field and together: every
+        other row is provably under the cutoff. None: the index cannot tell."""
+        title_rows = self.title_index.candidates(query, self.start, self.stop)
+        content_rows = self.content_index.candidates(query, self.start, self.stop)
+        if title_rows is None or content_rows is None:
+            return title_rows, content_rows, None
+        return title_rows, content_rows, np.union1d(title_rows, content_rows)
+
+    def search(self, query: str, workers: int = -1, candidates=None) -> list:
+        """Score ``query`` (already lowercased) against every document.
+
+        Only bigram-index candidates are scored (``candidates`` passes in a
+        result of ``self.candidates(query)``). Titles and contents are each
+        scored in one ``cdist`` call. Scores under the cutoff count as 0, which
+        cannot change a hit's boost: the field that reached the cutoff still
+        wins every comparison.
+        """
+        title_rows, content_rows, rows = candidates or self.candidates(query)
+        if rows is None:
+            rows = np.arange(len(self))
+        score_titles = self._field_scores(query, "title", rows, title_rows, workers)
+        score_contents = self._field_scores(query, "content", rows, content_rows, workers)
+        scores = np.maximum(score_titles, score_contents)
+
+        hits = []
+        for i in np.flatnonzero(scores >= SCORE_CUTOFF).tolist():
+            row = self.start + int(rows[i])
+            score_title = float(score_titles[i])
+            score_content = float(score_contents[i])
+            score = max(score_title, score_content)
+
+            if score_title == 100:
+                boosted_score = 200
+            elif score_content == 100:
+                boosted_score = 180
+            elif score_title > score_content:
+                boosted_score = score + 50
+            else:
+                boosted_score = score
+
+            hits.append({
+                "title": self.docs.get("title", row),
+                "url": self.docs.get("url", row),
+                "snippet": self.docs.get("content", row)[:SNIPPET_CHARS],
+                "score": boosted_score,
+                "source": "fuzzy"
+            })
+        return hits
+
+    def _field_scores(self, query: str, field: str, rows, candidates, workers: int) -> np.ndarray:
+        """Scores for ``rows``, computing only those in ``candidates`` (None: all)."""
+        if candidates is None:
+            candidates = rows
+        scores = np.zeros(len(rows), dtype=np.float64)
+        if len(candidates):
+            scores[np.searchsorted(rows, candidates)] = self._scores(
+                query, self._texts(field, candidates), workers
+            )
+        return scores
+
+    def _texts(self, field: str, rows) -> list:
+        """Lowercased ``field`` of ``rows``, decoded for this query only."""
+        if self.lowered:
+            return self.docs.take(f"{field}_lower", rows + self.start)
+        return [text.lower() for text in self.docs.take(field, rows + self.start)]
+
+    @staticmethod
+    def _scores(query: str, choices: list, workers: int) -> np.ndarray:
+        return process.cdist(
+            [query], choices, scorer=fuzz.partial_ratio, score_cutoff=SCORE_CUTOFF,
+            dtype=np.float64, workers=workers,
+        )[0]
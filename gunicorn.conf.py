@@ -0,0 +1,75 @@
+"""Gunicorn settings for the search API.
+
+The default is the original single process (``--workers 1 --threads 8``).
+``WEB_CONCURRENCY=N`` runs N worker processes instead, so CPU-bound fuzzy
+scoring and embedding no longer share one GIL:
+
+* the app is imported once in the master (``preload_app``) with the
+  embedding model loaded and ``PRELOAD_TENANTS`` warmed into the vectorstore
+  cache, then forked, so workers share those pages copy-on-write. The GC is
+  frozen before forking so collections in the workers do not touch (and
+  copy) the preloaded objects. FAISS indexes and docstores are mmapped and
+  shared through the page cache either way;
+* the cores are split between workers: ``OMP_NUM_THREADS`` (torch and FAISS),
+  ``EMBEDDING_THREADS``, ``FUZZY_WORKERS`` (rapidfuzz) and ``SEARCH_WORKERS``
+  (parallel searches of a /search/batch) default to cores // workers so N
+  workers do not each start a pool of all cores.
+
+With ``EMBEDDING_SERVER`` set the workers hold no model at all and embed
+through ``embedding_server.py``, sized separately.
+
+Nothing may run torch or FAISS in the master before the fork: an OpenMP pool
+started there does not survive it. Loading weights and mapping indexes is
+fine; the first forward pass happens in a worker.
+
+Each worker keeps its own result, query-embedding and vectorstore caches, so
+/stats describes the worker that answered it (see "worker" in the response).
+
+Comparing throughput per core against the single-process config, on the
+same machine and KB::
+
+    gunicorn -c gunicorn.conf.py app:app                      # 1 worker x 8 threads
+    WEB_CONCURRENCY=4 GUNICORN_THREADS=2 gunicorn -c gunicorn.conf.py app:app
+    python loadtest.py --tenant demo --queries queries.txt --concurrency 16 --duration 30
+
+``loadtest.py`` prints requests/s, requests/s per core and latency
+percentiles; run it with the result cache disabled (``RESULT_CACHE_SIZE=0``)
+so every request does the fuzzy and semantic work.
+
+Outstanding: this comparison has not been measured yet. It needs a
+multi-core host and the real MiniLM model. The only run so far used 1 vCPU,
+with the client on the same core and a 2-layer stand-in model. That run
+showed that 1 x 8, 2 x 4 and 4 x 2 all serve the keystroke trace from
+``benchmark.py`` without errors. It cannot show what extra workers gain
+per core. Keep ``WEB_CONCURRENCY`` at 1 until the comparison has been run
+on the production core count.
+"""
+import gc
+import os
+
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+bind = f":{os.environ.get('PORT', 8080)}"
+preload_app = workers > 1 or os.environ.get("GUNICORN_PRELOAD") == "1"
+
+cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+threads_per_worker = max(1, cores // workers)
+
+# Read when torch, FAISS and the app are imported, which happens after this
+# file is loaded (in the master with preload_app, else in each worker)
+if workers > 1:
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "EMBEDDING_THREADS", "FUZZY_WORKERS", "SEARCH_WORKERS"):
+        os.environ.setdefault(var, str(threads_per_worker))
+if preload_app:
+    os.environ.setdefault("EMBEDDING_PRELOAD", "1")
+
+
+def pre_fork(server, worker):
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    worker.log.info(
+        "worker %s: %s threads, OMP_NUM_THREADS=%s, FUZZY_WORKERS=%s",
+        worker.pid, threads, os.environ.get("OMP_NUM_THREADS"), os.environ.get("FUZZY_WORKERS"),
+    )
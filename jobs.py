@@ -0,0 +1,140 @@
+"""Background upload jobs.
+
+Jobs run on a small thread pool inside the web process. Their status is
+kept in memory and mirrored to ``<root>/<job_id>.json`` so that any gunicorn
+worker can answer ``/jobs/<id>``, not just the one running the job.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Progress is written to disk at most this often while a job is embedding
+_FLUSH_INTERVAL = 0.5
+
+
+class UploadJob:
+    def __init__(self, registry, tenant_id: str, docs_total: int):
+        self.id = uuid.uuid4().hex
+        self.tenant_id = tenant_id
+        self.status = "queued"
+        self.docs_total = docs_total
+        self.docs_to_embed = None
+        self.docs_embedded = 0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self._registry = registry
+        self._embed_started = None
+        self._last_flush = 0.0
+        self._lock = threading.Lock()
+
+    def set_embedding_total(self, count: int):
+        with self._lock:
+            self.docs_to_embed = count
+            self.docs_embedded = 0
+            self._embed_started = time.perf_counter()
+        self._flush()
+
+    def advance(self, count: int):
+        with self._lock:
+            self.docs_embedded += count
+        if time.perf_counter() - self._last_flush >= _FLUSH_INTERVAL:
+            self._flush()
+
+    def eta_seconds(self):
+        if self.status != "running" or not self.docs_to_embed or not self.docs_embedded:
+            return None
+        elapsed = time.perf_counter() - self._embed_started
+        rate = self.docs_embedded / elapsed
+        return round((self.docs_to_embed - self.docs_embedded) / rate, 1)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "job_id": self.id,
+                "tenant_id": self.tenant_id,
+                "status": self.status,
+                "docs_total": self.docs_total,
+                "docs_to_embed": self.docs_to_embed,
+                "docs_embedded": self.docs_embedded,
+                "eta_seconds": self.eta_seconds(),
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "result": self.result,
+                "error": self.error,
+            }
+
+    def _flush(self):
+        self._last_flush = time.perf_counter()
+        self._registry.persist(self)
+
+
+class JobRegistry:
+    """Runs upload jobs on a thread pool and tracks their progress."""
+
+    def __init__(self, root: str, workers: int = 2, keep: int = 1000):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.keep = keep
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload-job")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, tenant_id: str, docs_total: int, fn) -> UploadJob:
+        """Queue ``fn(job)``; whatever it returns becomes the job's result."""
+        job = UploadJob(self, tenant_id, docs_total)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.keep:
+                _, old = self._jobs.popitem(last=False)
+                self._remove(old.id)
+        self.persist(job)
+        self._executor.submit(self._run, job, fn)
+        return job
+
+    def get(self, job_id: str):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        # Possibly running, or finished, in another worker process
+        try:
+            with open(self._path(job_id)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def persist(self, job: UploadJob):
+        tmp = self._path(job.id) + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(job.to_dict(), f)
+        os.replace(tmp, self._path(job.id))
+
+    def _run(self, job: UploadJob, fn):
+        job.status = "running"
+        job.started_at = time.time()
+        self.persist(job)
+        try:
+            job.result = fn(job)
+            job.status = "succeeded"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "failed"
+        job.finished_at = time.time()
+        self.persist(job)
+
+    def _path(self, job_id: str) -> str:
+        return os.path.join(self.root, f"{os.path.basename(job_id)}.json")
+
+    def _remove(self, job_id: str):
+        try:
+            os.remove(self._path(job_id))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,88 @@
+"""Closed-loop HTTP load against a running /search, for comparing serving configs.
+
+    python loadtest.py --tenant demo --queries queries.txt --concurrency 16 --duration 30
+
+Each client thread sends its next query as soon as the previous answer
+arrives. Prints one JSON report: requests/s, requests/s per core (``--cores``,
+default: the cores of this machine, so run it on the server host or pass the
+server's count) and latency percentiles.
+"""
+import argparse
+import itertools
+import json
+import os
+import statistics
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+
+def run(base_url: str, tenant: str, queries: list, concurrency: int, duration: float) -> dict:
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+    query_cycle = itertools.cycle(queries)
+
+    def client():
+        nonlocal errors
+        while time.monotonic() < stop_at:
+            with lock:
+                query = next(query_cycle)
+            url = f"{base_url}/search?" + urllib.parse.urlencode({"tenant_id": tenant, "query": query})
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(url) as response:
+                    response.read()
+            except OSError:
+                with lock:
+                    errors += 1
+                continue
+            with lock:
+                latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.monotonic()
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for t in clients:
+        t.start()
+    for t in clients:
+        t.join()
+    elapsed = time.monotonic() - started
+
+    latencies.sort()
+    pct = lambda p: round(latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))], 2) if latencies else None
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 2),
+        "rps": round(len(latencies) / elapsed, 1),
+        "latency_ms": {
+            "mean": round(statistics.fmean(latencies), 2) if latencies else None,
+            "p50": pct(50),
+            "p95": pct(95),
+            "p99": pct(99),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--tenant", required=True)
+    parser.add_argument("--queries", required=True, help="file with one query per line")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--cores", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    with open(args.queries) as f:
+        queries = [line.strip() for line in f if line.strip()]
+    report = run(args.url.rstrip("/"), args.tenant, queries, args.concurrency, args.duration)
+    report["cores"] = args.cores
+    report["rps_per_core"] = round(report["rps"] / args.cores, 1)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""ONNX Runtime backend for the sentence-transformers embedding model.
+
+Export once, then select it with ``EMBEDDING_BACKEND=onnx`` and
+``ONNX_MODEL_DIR``::
+
+    python onnx_embeddings.py export --out models/minilm-onnx --quantize
+    python onnx_embeddings.py compare --onnx-dir models/minilm-onnx --quantized
+
+``export`` writes the transformer as ``model.onnx`` (plus a dynamic-int8
+``model_quantized.onnx`` with ``--quantize``), the fast tokenizer and an
+``embedding_config.json``. Inference tokenizes with the Rust ``tokenizers``
+library and mean-pools the last hidden state in numpy, reproducing the
+sentence-transformers pipeline without importing torch. ``compare`` reports
+cosine agreement with the torch model, latency and peak RSS of each backend.
+Exporting and quantizing also need the ``onnx`` package; serving only needs
+``onnxruntime``.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import time
+
+import numpy as np
+
+DEFAULT_MODEL = "sentence-transformers/paraphrase-MiniLM-L6-v2"
+MODEL_FILE = "model.onnx"
+QUANTIZED_MODEL_FILE = "model_quantized.onnx"
+CONFIG_FILE = "embedding_config.json"
+
+SAMPLE_TEXTS = [
+    "creta",
+    "swift diesel",
+    "Hyundai Creta 2019 SX diesel automatic, single owner, 42k km, sunroof",
+    "Maruti Swift VXI petrol manual with new tyres and full service history",
+    "Tata Nexon EV Max, 2022, fast charging, located in Pune",
+    "honda city petrol automatic",
+    "Toyota Innova Crysta 2.4 diesel, 7 seater, 85,000 km, Delhi registration",
+    "Used Mahindra XUV700 AX7 with ADAS, panoramic sunroof and alloy wheels",
+    "kia seltos 2020",
+    "Renault Kwid RXT 1.0 AMT, first owner, insurance valid till March",
+]
+
+
+class OnnxEmbeddings:
+    """Drop-in for ``HuggingFaceEmbeddings`` backed by an exported ONNX graph."""
+
+    def __init__(self, model_dir: str, quantized: bool = False, threads: int = 0, batch_size: int = 32):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        with open(os.path.join(model_dir, CONFIG_FILE)) as f:
+            self.config = json.load(f)
+        self.batch_size = batch_size
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=self.config["max_seq_length"])
+        self.tokenizer.enable_padding(pad_id=self.config["pad_token_id"], pad_token=self.config["pad_token"])
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        model_file = QUANTIZED_MODEL_FILE if quantized else MODEL_FILE
+        self.session = ort.InferenceSession(
+            os.path.join(model_dir, model_file), options, providers=["CPUExecutionProvider"]
+        )
+        self._input_names = {i.name for i in self.session.get_inputs()}
+
+    def embed_documents(self, texts: list) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, self.config["dim"]), dtype=np.float32)
+        return np.concatenate([
+            self._embed_batch(texts[i:i + self.batch_size]) for i in range(0, len(texts), self.batch_size)
+        ])
+
+    def embed_query(self, text: str) -> np.ndarray:
+        return self._embed_batch([text])[0]
+
+    def _embed_batch(self, texts: list) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        feeds = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+        }
+        hidden = self.session.run(None, {k: v for k, v in feeds.items() if k in self._input_names})[0]
+        # Mean pooling over real tokens, as in the sentence-transformers Pooling module
+        mask = feeds["attention_mask"][:, :, None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.config.get("normalize"):
+            pooled /= np.linalg.norm(pooled, axis=1, keepdims=True)
+        return pooled.astype(np.float32)
+
+
+def export(model_name: str, out_dir: str, max_seq_length: int = 128, quantize: bool = False):
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    os.makedirs(out_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+
+    class LastHiddenState(torch.nn.Module):
+        def __init__(self, inner):
+            super().__init__()
+            self.inner = inner
+
+        def forward(self, input_ids, attention_mask, token_type_ids):
+            return self.inner(
+                input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids
+            ).last_hidden_state
+
+    sample = tokenizer(["a sample input"], return_tensors="pt")
+    dynamic = {0: "batch", 1: "sequence"}
+    torch.onnx.export(
+        LastHiddenState(model),
+        (sample["input_ids"], sample["attention_mask"], sample["token_type_ids"]),
+        os.path.join(out_dir, MODEL_FILE),
+        input_names=["input_ids", "attention_mask", "token_type_ids"],
+        output_names=["last_hidden_state"],
+        dynamic_axes={
+            "input_ids": dynamic,
+            "attention_mask": dynamic,
+            "token_type_ids": dynamic,
+            "last_hidden_state": dynamic,
+        },
+        opset_version=17,
+        dynamo=False,
+    )
+    tokenizer.backend_tokenizer.save(os.path.join(out_dir, "tokenizer.json"))
+    with open(os.path.join(out_dir, CONFIG_FILE), "w") as f:
+        json.dump({
+            "model_name": model_name,
+            "max_seq_length": max_seq_length,
+            "dim": model.config.hidden_size,
+            "pad_token": tokenizer.pad_token,
+            "pad_token_id": tokenizer.pad_token_id,
+            "pooling": "mean",
+            "normalize": False,
+        }, f, indent=2)
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantize_dynamic(
+            os.path.join(out_dir, MODEL_FILE),
+            os.path.join(out_dir, QUANTIZED_MODEL_FILE),
+            weight_type=QuantType.QInt8,
+        )
+
+
+def compare(model_name: str, onnx_dir: str, quantized: bool, texts: list, runs: int = 20) -> dict:
+    """Cosine agreement of the ONNX backend(s) with torch, plus latency and RSS."""
+    specs = {"torch": {"backend": "torch", "model_name": model_name}}
+    specs["onnx"] = {"backend": "onnx", "model_name": model_name, "onnx_dir": onnx_dir}
+    if quantized:
+        specs["onnx-int8"] = dict(specs["onnx"], quantized=True)
+
+    # Each backend runs in a fresh process so its peak RSS is its own
+    ctx = multiprocessing.get_context("spawn")
+    report = {"texts": len(texts), "backends": {}}
+    with ctx.Pool(1, maxtasksperchild=1) as pool:
+        results = {name: pool.apply(_profile_backend, (spec, texts, runs)) for name, spec in specs.items()}
+
+    reference = results["torch"].pop("vectors")
+    for name, result in results.items():
+        vectors = result.pop("vectors", reference)
+        if name != "torch":
+            cosines = np.sum(vectors * reference, axis=1) / (
+                np.linalg.norm(vectors, axis=1) * np.linalg.norm(reference, axis=1)
+            )
+            result["cosine_min"] = float(cosines.min())
+            result["cosine_mean"] = float(cosines.mean())
+        report["backends"][name] = result
+    return report
+
+
+def _profile_backend(spec: dict, texts: list, runs: int) -> dict:
+    from embeddings import load_embedding_model
+
+    started = time.perf_counter()
+    model = load_embedding_model(**spec)
+    load_seconds = time.perf_counter() - started
+    vectors = np.asarray(model.embed_documents(texts), dtype=np.float32)
+
+    batch_ms = []
+    query_ms = []
+    for i in range(runs):
+        started = time.perf_counter()
+        model.embed_documents(texts)
+        batch_ms.append((time.perf_counter() - started) * 1000)
+        started = time.perf_counter()
+        model.embed_query(texts[i % len(texts)])
+        query_ms.append((time.perf_counter() - started) * 1000)
+
+    return {
+        "vectors": vectors,
+        "load_seconds": round(load_seconds, 3),
+        "batch_ms_p50": round(statistics.median(batch_ms), 3),
+        "query_ms_p50": round(statistics.median(query_ms), 3),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("export", help="export the model to ONNX")
+    p.add_argument("--model", default=DEFAULT_MODEL)
+    p.add_argument("--out", required=True)
+    p.add_argument("--max-seq-length", type=int, default=128)
+    p.add_argument("--quantize", action="store_true", help="also write a dynamic-int8 model")
+
+    p = sub.add_parser("compare", help="parity, latency and RSS against the torch model")
+    p.add_argument("--model", default=DEFAULT_MODEL)
+    p.add_argument("--onnx-dir", required=True)
+    p.add_argument("--quantized", action="store_true", help="also compare the int8 model")
+    p.add_argument("--texts", help="file with one text per line (default: built-in samples)")
+    p.add_argument("--runs", type=int, default=20)
+
+    args = parser.parse_args()
+    if args.command == "export":
+        export(args.model, args.out, args.max_seq_length, args.quantize)
+    else:
+        texts = SAMPLE_TEXTS
+        if args.texts:
+            with open(args.texts) as f:
+                texts = [line.strip() for line in f if line.strip()]
+        print(json.dumps(compare(args.model, args.onnx_dir, args.quantized, texts, args.runs), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,851 @@
+"""On-disk format for tenant knowledge bases.
+
+Each tenant lives in ``<root>/<tenant_id>/`` as immutable version directories
+plus a ``CURRENT`` pointer naming the live one:
+
+    CURRENT                    name of the live version directory
+    v<ns>/meta.json            format, row count, embedding dimension, columns, index spec
+    v<ns>/index.faiss          raw FAISS index written with faiss.write_index
+    v<ns>/keys.npy             int64 FAISS id of each row, ascending
+    v<ns>/deleted.npy          int64 ids removed but still in an HNSW graph, ascending
+    v<ns>/vectors.npy          float32 embedding of each row, exact
+    v<ns>/<column>.offsets.npy int64 byte offsets into the blob, one per row + 1
+    v<ns>/<column>.blob        the column's UTF-8 values, back to back
+    v<ns>/<field>_lower.*      lowercased title and content, as columns
+    v<ns>/<field>.bigram_*.npy fuzzy prefilter index over title and content
+
+Readers memory-map the index and the columns, so opening a version costs the
+same whatever the KB size and gunicorn workers share pages through the OS page
+cache. Writers build a new version beside the live one and flip ``CURRENT``
+with an atomic rename, so readers never see a half-written KB.
+
+Documents carry a stable ``doc_id`` and FAISS ids are never reused, so an
+update patches the previous index (remove changed ids, add new vectors)
+instead of re-embedding the whole KB. New rows are appended, which keeps
+``keys.npy`` sorted and lets search map FAISS ids to rows by bisection. The
+index structure (flat, HNSW or IVF) follows the KB size; see vector_index.py.
+
+Optionally, small tenants share pooled segments under ``<root>/_pool/``
+instead of a directory each, and move to a dedicated KB as they grow (see
+``load_tenant`` and the pool section below).
+"""
+import contextlib
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import shutil
+import threading
+import time
+import uuid
+from collections import Counter
+
+import faiss
+import numpy as np
+
+import vector_index
+from fuzzy import BigramIndex, FuzzyCorpus
+
+FORMAT_VERSION = 4
+COLUMNS = ("title", "url", "content")
+FUZZY_FIELDS = ("title", "content")
+ID_COLUMNS = ("doc_id", "content_hash")
+CURRENT_FILE = "CURRENT"
+MANIFEST_FILE = "MANIFEST"
+LOCK_FILE = ".lock"
+LEGACY_SUFFIX = ".pkl"
+VECTORS_FILE = "vectors.npy"
+DELETED_FILE = "deleted.npy"
+# Shared KB of small tenants; not a valid tenant id
+POOL_DIR = "_pool"
+# The previous version is kept so a reader that resolved CURRENT just before a
+# flip can still open it.
+KEEP_VERSIONS = 2
+
+# IO_FLAG_MMAP_IFC maps the codes of every index type, IVF lists included;
+# combined with IO_FLAG_MMAP it fails on IVF, so it is used alone when available
+_MMAP_FLAGS = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+# Pool segments beyond which a write also merges the smaller ones
+_MAX_SEGMENTS = 16
+_manifests = {}  # root -> (stamp, parsed MANIFEST) last read
+_segments = {}  # (root, segment) -> loaded TenantIndex
+_pool_lock = threading.Lock()
+
+
+class ColumnStore:
+    """Read-only string columns backed by an offsets array and a UTF-8 blob."""
+
+    def __init__(self, path: str, columns, count: int):
+        self.count = count
+        self.nbytes = 0
+        self._offsets = {}
+        self._blobs = {}
+        for name in columns:
+            offsets = np.load(os.path.join(path, f"{name}.offsets.npy"), mmap_mode="r")
+            blob = _map_file(os.path.join(path, f"{name}.blob"))
+            self._offsets[name] = offsets
+            self._blobs[name] = blob
+            self.nbytes += offsets.nbytes + len(blob)
+
+    def get(self, column: str, row: int) -> str:
+        offsets = self._offsets[column]
+        return self._blobs[column][offsets[row]:offsets[row + 1]].decode("utf-8")
+
+    def values(self, column: str, start: int = 0, stop: int = None) -> list:
+        stop = self.count if stop is None else stop
+        offsets = self._offsets[column][start:stop + 1].tolist()
+        blob = self._blobs[column]
+        return [blob[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(stop - start)]
+
+    def take(self, column: str, rows) -> list:
+        """Values of the given rows, in that order."""
+        offsets = self._offsets[column]
+        blob = self._blobs[column]
+        return [blob[a:b].decode("utf-8") for a, b in zip(offsets[rows].tolist(), offsets[rows + 1].tolist())]
+
+    @staticmethod
+    def write(path: str, columns: dict):
+        for name, values in columns.items():
+            encoded = [v.encode("utf-8") for v in values]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(b) for b in encoded], out=offsets[1:])
+            np.save(os.path.join(path, f"{name}.offsets.npy"), offsets)
+            with open(os.path.join(path, f"{name}.blob"), "wb") as f:
+                f.write(b"".join(encoded))
+
+
+class TenantIndex:
+    """A loaded, read-only version of one tenant's KB."""
+
+    def __init__(self, path: str, version: str, stamp, index, keys, docs: ColumnStore, meta: dict,
+                 deleted=None):
+        self.path = path
+        self.version = version
+        self.stamp = stamp
+        self.index = index
+        self.keys = keys
+        self.docs = docs
+        self.meta = meta
+        # Versions before format 3 only ever held a flat index
+        self.index_spec = meta.get("index", {"type": vector_index.FLAT})
+        self.deleted = deleted if deleted is not None else np.zeros(0, dtype=np.int64)
+        self.search_params = vector_index.excluding(self.index_spec, self.deleted)
+        self.index_nbytes = os.path.getsize(os.path.join(path, "index.faiss"))
+        self.mapped_nbytes = self.index_nbytes + keys.nbytes + docs.nbytes
+        self._fuzzy = None
+        self._vectors = None
+
+    def __len__(self):
+        return self.docs.count
+
+    @property
+    def nbytes(self) -> int:
+        return self.mapped_nbytes + (self._fuzzy.nbytes if self._fuzzy is not None else 0)
+
+    @property
+    def fuzzy(self) -> FuzzyCorpus:
+        return self.build_fuzzy()
+
+    def build_fuzzy(self) -> FuzzyCorpus:
+        """Open the fuzzy corpus; done once, when the version is loaded.
+
+        Versions before format 4 have no lowercased columns, and those before
+        the prefilter no bigram indexes, which are then built here.
+        """
+        if self._fuzzy is None:
+            if self.meta.get("bigram_index"):
+                indexes = [BigramIndex.load(self.path, field) for field in FUZZY_FIELDS]
+            else:
+                indexes = [BigramIndex.build([v.lower() for v in self.docs.values(field)]) for field in FUZZY_FIELDS]
+            self._fuzzy = FuzzyCorpus(self.docs, *indexes, lowered=self.meta["format"] >= 4)
+        return self._fuzzy
+
+    @property
+    def vectors(self):
+        """Exact vectors, mapped on first use; only re-ranking reads them."""
+        if self._vectors is None and self.meta["format"] >= 3:
+            self._vectors = np.load(os.path.join(self.path, VECTORS_FILE), mmap_mode="r")
+        return self._vectors
+
+    def index_stats(self) -> dict:
+        return dict(
+            self.index_spec,
+            vectors=len(self),
+            index_bytes=self.index_nbytes,
+            bytes_per_vector=round(self.index_nbytes / len(self), 1) if len(self) else 0.0,
+            deleted=len(self.deleted),
+            expected_recall=self.meta.get("expected_recall", 1.0),
+        )
+
+    def document(self, row: int) -> dict:
+        return {name: self.docs.get(name, row) for name in COLUMNS}
+
+    def documents(self):
+        columns = [self.docs.values(name) for name in COLUMNS]
+        for values in zip(*columns):
+            yield dict(zip(COLUMNS, values))
+
+    def similarity_search_with_score_by_vector(self, vector, k: int = 4) -> list:
+        return self.similarity_search_with_score_by_vectors([vector], k)[0]
+
+    def similarity_search_with_score_by_vectors(self, vectors, k: int = 4) -> list:
+        """One multi-query search; a (document, distance) list per vector."""
+        exact = self.vectors if self.index_spec.get("rerank") else None
+        distances, ids = vector_index.search(
+            self.index, self.index_spec, np.asarray(vectors, dtype=np.float32), k, self.keys, exact,
+            self.search_params,
+        )
+        results = []
+        for query_distances, query_ids in zip(distances, ids):
+            found = query_ids != -1
+            rows = np.searchsorted(self.keys, query_ids[found])
+            results.append([
+                (self.document(int(row)), float(distance))
+                for distance, row in zip(query_distances[found], rows)
+            ])
+        return results
+
+
+def tenant_dir(root: str, tenant_id: str) -> str:
+    return os.path.join(root, tenant_id)
+
+
+def legacy_pickle_path(root: str, tenant_id: str) -> str:
+    return os.path.join(root, f"{tenant_id}{LEGACY_SUFFIX}")
+
+
+def current_stamp(root: str, tenant_id: str):
+    """Cheap identity of the live version: changes whenever CURRENT is flipped.
+
+    Pooled tenants follow their own entry in the pool's MANIFEST.
+    """
+    return _stamp(tenant_dir(root, tenant_id)) or _pooled_stamp(root, tenant_id)
+
+
+def _stamp(base: str):
+    try:
+        st = os.stat(os.path.join(base, CURRENT_FILE))
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns)
+
+
+def load_tenant_index(root: str, tenant_id: str):
+    base = tenant_dir(root, tenant_id)
+    stamp = _stamp(base)
+    if stamp is None:
+        return None
+    with open(os.path.join(base, CURRENT_FILE)) as f:
+        version = f.read().strip()
+    return _load_version(os.path.join(base, version), version, stamp)
+
+
+def _load_version(path: str, version: str, stamp) -> TenantIndex:
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    index = faiss.read_index(os.path.join(path, "index.faiss"), _MMAP_FLAGS)
+    if "index" in meta:
+        vector_index.configure(index, meta["index"])
+    if meta["format"] >= 2:
+        keys = np.load(os.path.join(path, "keys.npy"), mmap_mode="r")
+    else:
+        # Format 1 indexes were plain IndexFlatL2: FAISS ids are row numbers
+        keys = np.arange(meta["count"], dtype=np.int64)
+    docs = ColumnStore(path, meta["columns"], meta["count"])
+    deleted = np.load(os.path.join(path, DELETED_FILE)) if meta.get("deleted") else None
+    return TenantIndex(path, version, stamp, index, keys, docs, meta, deleted)
+
+
+def save_tenant_index(root: str, tenant_id: str, index, keys, columns: dict, next_key: int,
+                      vectors: np.ndarray, index_spec: dict, previous=None, deleted=None) -> TenantIndex:
+    """Write ``index`` and its document columns as a new version and make it live.
+
+    ``index`` must be an id-mapped index built as ``index_spec`` whose ids are
+    ``keys``, in row order, plus any tombstoned ids in ``deleted``; ``vectors``
+    are the exact embeddings of the rows.
+    ``previous`` is the live version this one updates, the rows of it that are
+    kept (as the first rows) and those of them that were retitled; its bigram
+    indexes are then patched instead of rebuilt.
+    """
+    def write(path):
+        faiss.write_index(index, os.path.join(path, "index.faiss"))
+        np.save(os.path.join(path, "keys.npy"), np.asarray(keys, dtype=np.int64))
+        np.save(os.path.join(path, VECTORS_FILE), np.asarray(vectors, dtype=np.float32))
+        if deleted is not None and len(deleted):
+            np.save(os.path.join(path, DELETED_FILE), np.asarray(deleted, dtype=np.int64))
+        meta = {
+            "format": FORMAT_VERSION,
+            "count": len(keys),
+            "dim": int(index.d),
+            "columns": _write_docs(path, columns, previous),
+            "next_key": int(next_key),
+            "bigram_index": True,
+            "index": index_spec,
+            "deleted": 0 if deleted is None else len(deleted),
+            "expected_recall": vector_index.measure_recall(
+                index, index_spec, vectors, keys, vector_index.excluding(index_spec, deleted)
+            ),
+        }
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+    _publish_version(tenant_dir(root, tenant_id), write)
+    return load_tenant_index(root, tenant_id)
+
+
+def _write_docs(path: str, columns: dict, previous=None) -> list:
+    """Write the document columns, their lowercased fuzzy fields and the bigram
+    indexes over those; returns the names of the columns written."""
+    lowered = {f"{field}_lower": [v.lower() for v in columns[field]] for field in FUZZY_FIELDS}
+    ColumnStore.write(path, columns)
+    ColumnStore.write(path, lowered)
+    for field in FUZZY_FIELDS:
+        _bigram_index(lowered[f"{field}_lower"], field, previous).save(path, field)
+    return list(columns) + list(lowered)
+
+
+def _bigram_index(texts: list, field: str, previous) -> BigramIndex:
+    """The bigram index of ``texts``, patched from ``previous`` when it has one."""
+    if previous is None or not previous[0].meta.get("bigram_index"):
+        return BigramIndex.build(texts)
+    live, kept, retitled = previous
+    appended = np.arange(len(kept), len(texts))
+    # Contents never change in place: a new content is a new row
+    changed = np.concatenate([retitled, appended]) if field == "title" else appended
+    return BigramIndex.load(live.path, field).patched(kept, len(texts), changed, [texts[row] for row in changed])
+
+
+def _publish_version(base: str, write):
+    """Build a new version directory with ``write(path)`` and point CURRENT at it."""
+    version = _write_dir(base, "v", write)
+    _replace_file(base, CURRENT_FILE, version)
+    _prune_versions(base)
+    return version
+
+
+def _write_dir(base: str, prefix: str, write) -> str:
+    """Build a new, complete directory ``<prefix><ns>`` with ``write(path)``; returns its name."""
+    os.makedirs(base, exist_ok=True)
+    tmp = os.path.join(base, f".tmp-{uuid.uuid4().hex}")
+    os.makedirs(tmp)
+    try:
+        write(tmp)
+        name = f"{prefix}{time.time_ns():020d}"
+        os.rename(tmp, os.path.join(base, name))
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return name
+
+
+def _replace_file(base: str, name: str, text: str):
+    """Atomically replace ``base/name`` with ``text``."""
+    tmp = os.path.join(base, f".{name}-{uuid.uuid4().hex}")
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, os.path.join(base, name))
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def assign_doc_ids(docs: list) -> list:
+    """Stable identity for each posted doc: its ``id``, else its ``url``, else its content.
+
+    Repeats within one upload get an ``#n`` suffix so that, like before, every
+    posted doc is indexed even when several share a URL.
+    """
+    seen = Counter()
+    ids = []
+    for d in docs:
+        base = str(d.get("id") or d.get("url") or content_hash(d["content"]))
+        n = seen[base]
+        seen[base] += 1
+        ids.append(base if n == 0 else f"{base}#{n}")
+    return ids
+
+
+def update_tenant_index(root: str, tenant_id: str, docs: list, embed, delete_ids=(), replace: bool = False,
+                        index_options: dict = None, pool_max_docs: int = 0):
+    """Apply an upload to the tenant's KB, re-embedding only what changed.
+
+    ``docs`` are dicts with ``title``, ``url`` and ``content``, and optionally
+    ``id``. With ``replace`` the KB ends up holding exactly ``docs``; otherwise
+    they are upserted and ``delete_ids`` removed. ``embed`` maps a list of texts
+    to a float32 matrix. ``index_options`` override ``vector_index.DEFAULT_OPTIONS``.
+    With ``pool_max_docs``, a tenant without a dedicated KB keeps up to that
+    many docs in the shared pool and graduates to a dedicated KB beyond it;
+    tenants already pooled graduate on their next upload when it is 0.
+    Returns the live KB (None if the tenant has none) and a summary of what
+    changed.
+    """
+    base = tenant_dir(root, tenant_id)
+    if _stamp(base) is None and (pool_max_docs or tenant_id in _read_manifest(root)["tenants"]):
+        with _locked(tenant_dir(root, POOL_DIR)):
+            # Checked again under the lock: another upload may have graduated it
+            if _stamp(base) is None:
+                return _update_pooled(root, tenant_id, docs, embed, delete_ids, replace, index_options, pool_max_docs)
+
+    # Serializes read-modify-write across gunicorn workers
+    with _locked(base):
+        if _stamp(base) is None:
+            # A KB only in the legacy format is converted first, or the new
+            # version would hide its docs for good
+            _migrate_legacy_pickle(root, tenant_id, index_options)
+        live, current = _load_for_update(root, tenant_id)
+        summary, update = _merge(current, docs, embed, delete_ids, replace)
+        if update is None:
+            return live, summary
+        return _save_update(root, tenant_id, live, update, index_options), summary
+
+
+def _load_for_update(root: str, tenant_id: str):
+    live = load_tenant_index(root, tenant_id)
+    if live is None:
+        return None, None
+    columns = {name: live.docs.values(name) for name in COLUMNS}
+    if live.meta["format"] >= 2:
+        for name in ID_COLUMNS:
+            columns[name] = live.docs.values(name)
+        keys = np.array(live.keys)
+        next_key = live.meta["next_key"]
+    else:
+        keys = np.arange(len(live), dtype=np.int64)
+        next_key = len(live)
+        docs = [{"url": u, "content": c} for u, c in zip(columns["url"], columns["content"])]
+        columns["doc_id"] = assign_doc_ids(docs)
+        columns["content_hash"] = [content_hash(c) for c in columns["content"]]
+    return live, (keys, columns, next_key, _stored_vectors(live))
+
+
+def _stored_vectors(live: TenantIndex) -> np.ndarray:
+    if live.meta["format"] >= 3:
+        return np.load(os.path.join(live.path, VECTORS_FILE), mmap_mode="r")
+    # Older versions only hold a flat index, whose storage is in row order
+    flat = live.index if live.meta["format"] < 2 else faiss.downcast_index(live.index.index)
+    return flat.reconstruct_n(0, len(live))
+
+
+def _merge(current, docs, embed, delete_ids, replace):
+    """Diff an upload against ``current`` (keys, columns, next key and vectors
+    of a KB, or None) and embed what is new.
+
+    Returns the change summary and, unless nothing changed, the KB's new rows
+    plus the keys removed and added on the way, for patching an index, and
+    which old rows were kept and retitled, for patching the bigram indexes.
+    """
+    if current is None:
+        keys, columns, next_key, vectors = np.zeros(0, dtype=np.int64), {n: [] for n in COLUMNS + ID_COLUMNS}, 0, None
+    else:
+        keys, columns, next_key, vectors = current
+    row_of = {doc_id: row for row, doc_id in enumerate(columns["doc_id"])}
+
+    removed_rows = set()
+    retitled_rows = set()
+    new_docs = []
+    summary = {"added": 0, "updated": 0, "unchanged": 0, "deleted": 0, "new_vectors": 0}
+    posted_ids = assign_doc_ids(docs)
+    for doc_id, d in zip(posted_ids, docs):
+        h = content_hash(d["content"])
+        row = row_of.get(doc_id)
+        if row is None:
+            summary["added"] += 1
+            new_docs.append((doc_id, h, d))
+        elif columns["content_hash"][row] != h:
+            # Content changed: the old vector goes and a fresh one is embedded
+            summary["updated"] += 1
+            removed_rows.add(row)
+            new_docs.append((doc_id, h, d))
+        elif columns["title"][row] != d["title"] or columns["url"][row] != d["url"]:
+            # Metadata only: patch the columns, keep the vector
+            summary["updated"] += 1
+            if columns["title"][row] != d["title"]:
+                retitled_rows.add(row)
+            columns["title"][row] = d["title"]
+            columns["url"][row] = d["url"]
+        else:
+            summary["unchanged"] += 1
+
+    if replace:
+        doomed = set(row_of) - set(posted_ids)
+    else:
+        doomed = {str(doc_id) for doc_id in delete_ids}
+    for doc_id in doomed:
+        row = row_of.get(doc_id)
+        if row is not None:
+            summary["deleted"] += 1
+            removed_rows.add(row)
+
+    changed = summary["added"] + summary["updated"] + summary["deleted"]
+    if not changed:
+        return summary, None
+
+    new_vectors = None
+    if new_docs:
+        new_vectors = np.ascontiguousarray(embed([d["content"] for _, _, d in new_docs]), dtype=np.float32)
+        summary["new_vectors"] = len(new_docs)
+    if vectors is None:
+        # A new KB always has something to embed
+        vectors = np.zeros((0, new_vectors.shape[1]), dtype=np.float32)
+
+    keep = np.array([row not in removed_rows for row in range(len(keys))], dtype=bool)
+    new_keys = np.arange(next_key, next_key + len(new_docs), dtype=np.int64)
+    kept = np.flatnonzero(keep)
+    out = {name: [columns[name][row] for row in kept] for name in COLUMNS + ID_COLUMNS}
+    for doc_id, h, d in new_docs:
+        out["title"].append(d["title"])
+        out["url"].append(d["url"])
+        out["content"].append(d["content"])
+        out["doc_id"].append(doc_id)
+        out["content_hash"].append(h)
+    return summary, {
+        "keys": np.concatenate([keys[keep], new_keys]),
+        "columns": out,
+        "vectors": vectors[keep] if new_vectors is None else np.concatenate([vectors[keep], new_vectors]),
+        "next_key": next_key + len(new_docs),
+        "removed_keys": keys[~keep],
+        "new_keys": new_keys,
+        "new_vectors": new_vectors,
+        "kept_rows": kept,
+        "retitled_rows": np.searchsorted(kept, sorted(retitled_rows - removed_rows)).astype(np.int64),
+    }
+
+
+def _save_update(root, tenant_id, live, update, index_options):
+    keys, vectors = update["keys"], update["vectors"]
+    current_spec = live.index_spec if live is not None and live.meta["format"] >= 2 else None
+    spec = vector_index.choose_spec(len(keys), vectors.shape[1], index_options, current_spec)
+    deleted = None
+    if vector_index.keeps_tombstones(spec):
+        # Removed ids join the live version's tombstones instead of forcing a rebuild
+        deleted = np.union1d(live.deleted, update["removed_keys"]) if live is not None else update["removed_keys"]
+    deleted_fraction = len(deleted) / (len(keys) + len(deleted)) if deleted is not None and len(deleted) else 0.0
+    if (vector_index.can_patch(current_spec, spec, deleted_fraction, index_options)
+            and vector_index.holds_ids_as_built(live.index, spec)):
+        # Read a private, writable copy: the serving copy is a read-only mapping
+        index = faiss.read_index(os.path.join(live.path, "index.faiss"))
+        if len(update["removed_keys"]) and deleted is None:
+            index.remove_ids(update["removed_keys"])
+        if update["new_vectors"] is not None:
+            index.add_with_ids(update["new_vectors"], update["new_keys"])
+        vector_index.configure(index, spec)
+    else:
+        index = vector_index.build(spec, vectors, keys)
+        deleted = None
+    previous = (live, update["kept_rows"], update["retitled_rows"]) if live is not None else None
+    return save_tenant_index(
+        root, tenant_id, index, keys, update["columns"], update["next_key"], vectors, spec, previous, deleted
+    )
+
+
+# ---------- Shared pool for small tenants ----------
+#
+# Tenants below a size threshold can share a KB under ``<root>/_pool/``
+# instead of a directory each:
+#
+#     MANIFEST    JSON: each tenant's segment, row range, next key and revision
+#     s<ns>/      a segment: a version directory holding the rows of one or
+#                 more tenants, with a plain IndexFlatL2 (exact, so there is no
+#                 vectors.npy) whose ids are row numbers
+#
+# Segments are immutable. A write puts the tenant's new rows in a segment of
+# their own and replaces MANIFEST, so it costs the tenant's size rather than
+# the pool's, and the rows it supersedes become garbage. Segments that are
+# mostly garbage, and the smaller half once there are _MAX_SEGMENTS of them,
+# are merged into the new segment by the same write.
+#
+# A tenant's rows are one contiguous range of its segment. Search restricts
+# the flat scan to that range with an IDSelectorRange, and the bigram indexes
+# by bisecting their postings, so it also costs the tenant's size. Freshness
+# is per tenant: its stamp is its revision, unique across the pool, so a
+# write to one pooled tenant reloads no other, not even one whose rows a
+# merge moved (the segment it was loaded from stays mapped). Loaded segments
+# are shared by all the tenants in them.
+
+def load_tenant(root: str, tenant_id: str):
+    """The tenant's KB, dedicated or pooled; None if it has neither."""
+    if tenant_id == POOL_DIR:
+        return None
+    live = load_tenant_index(root, tenant_id)
+    if live is not None:
+        return live
+    entry = _read_manifest(root)["tenants"].get(tenant_id)
+    return PooledTenant(_load_segment(root, entry["segment"]), tenant_id, entry) if entry is not None else None
+
+
+def _pooled_stamp(root: str, tenant_id: str):
+    entry = _read_manifest(root)["tenants"].get(tenant_id)
+    return (POOL_DIR, entry["revision"]) if entry is not None else None
+
+
+def _read_manifest(root: str) -> dict:
+    """The pool's MANIFEST, parsed again only once it has been replaced."""
+    path = os.path.join(tenant_dir(root, POOL_DIR), MANIFEST_FILE)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return {"tenants": {}, "segments": {}, "next_revision": 1}
+    stamp = (st.st_ino, st.st_mtime_ns)
+    with _pool_lock:
+        cached = _manifests.get(root)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+    with open(path) as f:
+        manifest = json.load(f)
+    with _pool_lock:
+        _manifests[root] = (stamp, manifest)
+        # Tenants already loaded from a dropped segment keep it mapped themselves
+        for key in [key for key in _segments if key[0] == root and key[1] not in manifest["segments"]]:
+            del _segments[key]
+    return manifest
+
+
+def _load_segment(root: str, name: str) -> TenantIndex:
+    key = (root, name)
+    with _pool_lock:
+        segment = _segments.get(key)
+    if segment is None:
+        segment = _load_version(os.path.join(tenant_dir(root, POOL_DIR), name), name, name)
+        segment.build_fuzzy()
+        with _pool_lock:
+            segment = _segments.setdefault(key, segment)
+    return segment
+
+
+class PooledTenant:
+    """One tenant's rows in a pool segment, served like a ``TenantIndex``."""
+
+    def __init__(self, segment: TenantIndex, tenant_id: str, entry: dict):
+        self.segment = segment
+        self.tenant_id = tenant_id
+        self.start = entry["start"]
+        self.stop = entry["stop"]
+        self.version = f"{POOL_DIR}.{entry['revision']}"
+        self.stamp = (POOL_DIR, entry["revision"])
+        self.index_spec = {"type": vector_index.FLAT, "compression": vector_index.NONE, "pooled": True}
+        # This tenant's share of the segment's mapped files
+        self.mapped_nbytes = segment.mapped_nbytes * len(self) // max(len(segment), 1)
+        self._fuzzy = None
+
+    def __len__(self):
+        return self.stop - self.start
+
+    @property
+    def nbytes(self) -> int:
+        return self.segment.nbytes * len(self) // max(len(self.segment), 1)
+
+    @property
+    def fuzzy(self) -> FuzzyCorpus:
+        return self.build_fuzzy()
+
+    def build_fuzzy(self) -> FuzzyCorpus:
+        """This tenant's range of the segment's fuzzy corpus."""
+        if self._fuzzy is None:
+            shared = self.segment.build_fuzzy()
+            self._fuzzy = FuzzyCorpus(
+                self.segment.docs, shared.title_index, shared.content_index, start=self.start, stop=self.stop
+            )
+        return self._fuzzy
+
+    def index_stats(self) -> dict:
+        return dict(
+            self.index_spec,
+            vectors=len(self),
+            index_bytes=self.mapped_nbytes,
+            bytes_per_vector=round(self.segment.index_nbytes / len(self.segment), 1) if len(self.segment) else 0.0,
+            deleted=0,
+            expected_recall=1.0,
+        )
+
+    def document(self, row: int) -> dict:
+        return self.segment.document(self.start + row)
+
+    def documents(self):
+        columns = [self.segment.docs.values(name, self.start, self.stop) for name in COLUMNS]
+        for values in zip(*columns):
+            yield dict(zip(COLUMNS, values))
+
+    def similarity_search_with_score_by_vector(self, vector, k: int = 4) -> list:
+        return self.similarity_search_with_score_by_vectors([vector], k)[0]
+
+    def similarity_search_with_score_by_vectors(self, vectors, k: int = 4) -> list:
+        params = faiss.SearchParameters(sel=faiss.IDSelectorRange(self.start, self.stop, True))
+        distances, rows = vector_index.search(
+            self.segment.index, self.segment.index_spec, np.asarray(vectors, dtype=np.float32), k, params=params
+        )
+        results = []
+        for query_distances, query_rows in zip(distances, rows):
+            found = query_rows != -1
+            results.append([
+                (self.segment.document(int(row)), float(distance))
+                for distance, row in zip(query_distances[found], query_rows[found])
+            ])
+        return results
+
+
+def _update_pooled(root, tenant_id, docs, embed, delete_ids, replace, index_options, pool_max_docs):
+    manifest = _read_manifest(root)
+    entry = manifest["tenants"].get(tenant_id)
+    # A tenant with a legacy KB starts from its docs, wherever it ends up
+    current = _read_legacy_pickle(root, tenant_id) if entry is None else _pooled_rows(root, entry)
+    summary, update = _merge(current, docs, embed, delete_ids, replace)
+    if update is None:
+        return load_tenant(root, tenant_id), summary
+
+    if len(update["keys"]) > pool_max_docs:
+        # Graduates: the dedicated KB goes live first, then leaves the pool
+        live = _save_update(root, tenant_id, None, update, index_options)
+        if entry is not None:
+            _save_pool(root, manifest, tenant_id, None)
+        return live, summary
+    _save_pool(root, manifest, tenant_id, update)
+    return load_tenant(root, tenant_id), summary
+
+
+def _pooled_rows(root: str, entry: dict):
+    """Keys, columns, next key and vectors of a pooled tenant, like ``_load_for_update``."""
+    segment = _load_segment(root, entry["segment"])
+    start, stop = entry["start"], entry["stop"]
+    vectors = np.zeros((0, segment.meta["dim"]), dtype=np.float32)
+    if stop > start:
+        vectors = segment.index.reconstruct_n(start, stop - start)
+    return (
+        np.array(segment.keys[start:stop]),
+        {name: segment.docs.values(name, start, stop) for name in COLUMNS + ID_COLUMNS},
+        entry["next_key"],
+        vectors,
+    )
+
+
+def _save_pool(root: str, manifest: dict, tenant_id: str, update):
+    """Replace ``tenant_id``'s rows with ``update``'s in a new segment (None: drop them)."""
+    base = tenant_dir(root, POOL_DIR)
+    tenants = {t: dict(e) for t, e in manifest["tenants"].items() if t != tenant_id}
+    revision = manifest["next_revision"]
+    blocks = []  # (tenant, entry fields, (keys, columns, next key, vectors))
+    if update is not None:
+        rows = (update["keys"], update["columns"], update["next_key"], update["vectors"])
+        blocks.append((tenant_id, {"revision": revision}, rows))
+
+    live_rows = Counter()
+    for e in tenants.values():
+        live_rows[e["segment"]] += e["stop"] - e["start"]
+    merged = {name for name in live_rows if 2 * live_rows[name] < manifest["segments"][name]}
+    rest = sorted(set(live_rows) - merged, key=live_rows.get)
+    if len(rest) >= _MAX_SEGMENTS:
+        merged.update(rest[:len(rest) // 2])
+    for t, e in tenants.items():
+        if e["segment"] in merged:
+            blocks.append((t, {"revision": e["revision"]}, _pooled_rows(root, e)))
+
+    segments = {name: count for name, count in manifest["segments"].items() if name in live_rows and name not in merged}
+    if blocks:
+        name, ranges = _write_segment(base, [rows for _, _, rows in blocks])
+        segments[name] = ranges[-1][1]
+        for (t, fields, rows), (start, stop) in zip(blocks, ranges):
+            tenants[t] = dict(fields, segment=name, start=start, stop=stop, next_key=int(rows[2]))
+
+    new_manifest = {"tenants": tenants, "segments": segments, "next_revision": revision + 1}
+    _replace_file(base, MANIFEST_FILE, json.dumps(new_manifest))
+    # Segments of the previous manifest stay for readers that resolved it just before
+    keep = set(segments) | set(manifest["segments"])
+    for name in os.listdir(base):
+        if name.startswith("s") and name not in keep:
+            shutil.rmtree(os.path.join(base, name), ignore_errors=True)
+
+
+def _write_segment(base: str, blocks: list):
+    """Write the rows of ``blocks`` back to back as a new segment; returns its
+    name and each block's row range."""
+    keys = np.concatenate([rows[0] for rows in blocks]).astype(np.int64)
+    vectors = np.ascontiguousarray(np.concatenate([rows[3] for rows in blocks]), dtype=np.float32)
+    columns = {name: [v for rows in blocks for v in rows[1][name]] for name in COLUMNS + ID_COLUMNS}
+    bounds = np.cumsum([0] + [len(rows[0]) for rows in blocks]).tolist()
+    index = faiss.IndexFlatL2(vectors.shape[1])
+    index.add(vectors)
+
+    def write(path):
+        faiss.write_index(index, os.path.join(path, "index.faiss"))
+        np.save(os.path.join(path, "keys.npy"), keys)
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({
+                "format": FORMAT_VERSION,
+                "count": len(keys),
+                "dim": int(vectors.shape[1]),
+                "columns": _write_docs(path, columns),
+                "bigram_index": True,
+                "index": {"type": vector_index.FLAT, "compression": vector_index.NONE},
+            }, f)
+
+    return _write_dir(base, "s", write), list(zip(bounds[:-1], bounds[1:]))
+
+
+def migrate_legacy_pickle(root: str, tenant_id: str, index_options: dict = None):
+    """Convert ``<tenant>.pkl`` (a pickled LangChain FAISS store) to the native format.
+
+    The pickle is left in place; the native version takes precedence from now on.
+    """
+    if not os.path.exists(legacy_pickle_path(root, tenant_id)):
+        return None
+    with _locked(tenant_dir(root, tenant_id)):
+        # Another worker may have converted it, or an upload replaced it, meanwhile
+        return load_tenant_index(root, tenant_id) or _migrate_legacy_pickle(root, tenant_id, index_options)
+
+
+def _migrate_legacy_pickle(root: str, tenant_id: str, index_options: dict = None):
+    legacy = _read_legacy_pickle(root, tenant_id)
+    if legacy is None:
+        return None
+    keys, columns, count, vectors = legacy
+    spec = vector_index.choose_spec(count, vectors.shape[1], index_options)
+    index = vector_index.build(spec, vectors, keys)
+    return save_tenant_index(root, tenant_id, index, keys, columns, count, vectors, spec)
+
+
+def _read_legacy_pickle(root: str, tenant_id: str):
+    """Keys, columns, next key and vectors of a legacy KB, like ``_load_for_update``."""
+    path = legacy_pickle_path(root, tenant_id)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        vectorstore = pickle.load(f)
+
+    count = vectorstore.index.ntotal
+    columns = {name: [] for name in COLUMNS}
+    for i in range(count):
+        doc = vectorstore.docstore.search(vectorstore.index_to_docstore_id[i])
+        columns["title"].append(doc.metadata.get("title", "Untitled"))
+        columns["url"].append(doc.metadata.get("url", ""))
+        columns["content"].append(doc.page_content)
+    docs = [{"url": u, "content": c} for u, c in zip(columns["url"], columns["content"])]
+    columns["doc_id"] = assign_doc_ids(docs)
+    columns["content_hash"] = [content_hash(c) for c in columns["content"]]
+
+    keys = np.arange(count, dtype=np.int64)
+    vectors = vectorstore.index.reconstruct_n(0, count).reshape(count, vectorstore.index.d)
+    return keys, columns, count, vectors
+
+
+@contextlib.contextmanager
+def _locked(base: str):
+    """Hold the exclusive write lock of a tenant (or pool) directory."""
+    os.makedirs(base, exist_ok=True)
+    with open(os.path.join(base, LOCK_FILE), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _map_file(path: str):
+    if os.path.getsize(path) == 0:
+        return b""
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _prune_versions(base: str):
+    versions = sorted(name for name in os.listdir(base) if name.startswith("v"))
+    for name in versions[:-KEEP_VERSIONS]:
+        shutil.rmtree(os.path.join(base, name), ignore_errors=True)
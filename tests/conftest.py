@@ -0,0 +1,50 @@
+"""Shared fixtures: the app in a scratch directory with a deterministic embedding model."""
+import hashlib
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class HashingEmbeddings:
+    """Bag-of-words vectors from word hashes: deterministic, and no model to load."""
+
+    dim = 64
+
+    def embed_documents(self, texts: list) -> list:
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> list:
+        return self._vector(text)
+
+    def _vector(self, text: str) -> list:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in text.lower().split():
+            vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % self.dim] += 1.0
+        return vector.tolist()
+
+
+@pytest.fixture
+def hashing_model():
+    return HashingEmbeddings()
+
+
+@pytest.fixture(scope="session")
+def app_module(tmp_path_factory):
+    """The app module, serving KBs from a temporary directory."""
+    workdir = tmp_path_factory.mktemp("app")
+    cwd = os.getcwd()
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("RESULT_CACHE_SIZE", "0")
+        mp.setenv("EMBEDDING_CACHE_DIR", str(workdir / "embedding_cache"))
+        # KBs live in ./vector_dbs
+        os.chdir(workdir)
+        import app
+        app.embedding_model._model = HashingEmbeddings()
+        try:
+            yield app
+        finally:
+            os.chdir(cwd)
@@ -0,0 +1,80 @@
+"""The per-worker caches in front of the KBs: loaded vectorstores and /search results."""
+import pytest
+
+import storage
+
+
+@pytest.fixture(scope="module")
+def client(app_module):
+    client = app_module.app.test_client()
+    for tenant in ("cache-a", "cache-b"):
+        docs = [{"title": f"{tenant} car {i}", "url": f"{tenant}/{i}", "content": f"{tenant} petrol {i}"}
+                for i in range(20)]
+        assert client.post("/upload", json={"tenant_id": tenant, "docs": docs}).status_code == 200
+    return client
+
+
+def embedder(app_module):
+    return lambda texts: app_module.embedding_model.embed_documents(texts)
+
+
+def test_vectorstore_cache_reloads_a_kb_replaced_on_disk(client, app_module):
+    cache = app_module.VectorstoreCache(1 << 30)
+    first = cache.get("cache-a")
+    assert cache.get("cache-a") is first and cache.stats()["hits"] == 1
+    # Another worker's upload only shows on disk
+    storage.update_tenant_index(app_module.VECTOR_DB_DIR, "cache-a",
+                                [{"title": "new", "url": "cache-a/new", "content": "fresh"}], embedder(app_module))
+    second = cache.get("cache-a")
+    assert second is not first and second.version != first.version and len(second) == 21
+    assert cache.stats()["invalidations"] == 1
+    assert cache.get("nobody") is None
+
+
+def test_vectorstore_cache_evicts_least_recently_used_bytes(client, app_module):
+    sizes = app_module.VectorstoreCache(1 << 30)
+    budget = max(sizes.get("cache-a").nbytes, sizes.get("cache-b").nbytes)
+    # Room for either KB, not both
+    cache = app_module.VectorstoreCache(budget)
+    b = cache.get("cache-b")
+    cache.get("cache-a")
+    stats = cache.stats()
+    assert stats["entries"] == 1 and stats["evictions"] == 1 and stats["bytes"] <= budget
+    assert cache.get("cache-b") is not b
+
+    # A KB over the whole budget is served, just not kept
+    tiny = app_module.VectorstoreCache(1)
+    assert tiny.get("cache-a") is not None and tiny.stats()["entries"] == 0
+
+
+def test_result_cache_expires_and_evicts(app_module, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(app_module.time, "monotonic", lambda: now[0])
+    cache = app_module.ResultCache(max_entries=2, ttl_seconds=10)
+    cache.put("t", "swift", "v1", ["a"])
+    assert cache.get("t", "swift", "v1") == ["a"]
+    assert cache.get("t", "swift", "v2") is None
+    now[0] += 11
+    assert cache.get("t", "swift", "v1") is None
+
+    for query in ("a", "b", "c"):
+        cache.put("t", query, "v1", [query])
+    assert cache.get("t", "a", "v1") is None and cache.get("t", "c", "v1") == ["c"]
+    assert cache.stats()["evictions"] == 1
+    cache.put("u", "c", "v1", ["u"])
+    cache.invalidate_tenant("t")
+    assert cache.get("t", "c", "v1") is None and cache.get("u", "c", "v1") == ["u"]
+
+
+def test_search_results_are_cached_until_the_kb_changes(client, app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "result_cache", app_module.ResultCache(100, 60))
+    query = {"tenant_id": "cache-b", "query": "zebra"}
+    first = client.get("/search", query_string=query).json
+    assert client.get("/search", query_string=query).json == first
+    assert app_module.result_cache.stats()["hits"] == 1
+
+    docs = [{"title": "zebra", "url": "cache-b/zebra", "content": "cache-b diesel"}]
+    client.post("/upload", json={"tenant_id": "cache-b", "mode": "upsert", "docs": docs})
+    assert app_module.result_cache.stats()["entries"] == 0
+    second = client.get("/search", query_string=query).json
+    assert second[0]["url"] == "cache-b/zebra" and second != first
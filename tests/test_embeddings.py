@@ -0,0 +1,117 @@
+"""Embedding caches and query micro-batching around a deterministic model."""
+import threading
+
+import numpy as np
+
+import pytest
+
+from embeddings import CachedEmbedder, EmbeddingCache, QueryBatcher, QueryEmbeddingCache
+
+
+def test_batched_query_vectors_are_cached_on_their_own(hashing_model):
+    batcher = QueryBatcher(hashing_model, max_batch=8, max_wait_ms=50)
+    cache = QueryEmbeddingCache(batcher, "hashing")
+    texts = [f"swift diesel {i % 12}" for i in range(24)]
+    barrier = threading.Barrier(len(texts))
+    results = {}
+
+    def search(i):
+        barrier.wait()
+        results[i] = cache.embed_query(texts[i])
+
+    threads = [threading.Thread(target=search, args=(i,)) for i in range(len(texts))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for i, text in enumerate(texts):
+        assert np.array_equal(results[i], hashing_model.embed_query(text))
+    stats = batcher.stats()
+    assert stats["items"] <= len(texts) and stats["batches"] < stats["items"]
+    # Each cached vector owns its data instead of viewing its micro-batch
+    assert all(vector.base is None for vector in cache._entries.values())
+    assert cache.stats()["entries"] == 12
+
+
+class CountingModel:
+    def __init__(self, model):
+        self.model = model
+        self.texts = []
+
+    def embed_query(self, text):
+        self.texts.append(text)
+        return self.model.embed_query(text)
+
+    def embed_queries(self, texts):
+        self.texts.extend(texts)
+        return self.model.embed_documents(texts)
+
+
+def test_query_cache_is_an_lru_over_normalized_text(hashing_model):
+    model = CountingModel(hashing_model)
+    cache = QueryEmbeddingCache(model, "hashing", max_entries=2)
+    first = cache.embed_query("swift  diesel")
+    assert cache.embed_query(" swift diesel\n") is first
+    cache.embed_query("creta")
+    cache.embed_query("swift diesel")
+    cache.embed_query("nexon")  # evicts "creta", the least recently used
+    assert cache.embed_queries(["swift diesel", "creta", "creta"])[0] is first
+    assert model.texts == ["swift diesel", "creta", "nexon", "creta"]
+    assert cache.stats()["entries"] == 2
+
+
+def test_query_cache_snapshot_is_reloaded_for_the_same_model_only(hashing_model, tmp_path):
+    path = str(tmp_path / "queries.npz")
+    cache = QueryEmbeddingCache(CountingModel(hashing_model), "hashing", path=path)
+    cache.embed_queries(["swift", "creta"])
+    cache.save()
+
+    model = CountingModel(hashing_model)
+    warm = QueryEmbeddingCache(model, "hashing", path=path)
+    assert np.array_equal(warm.embed_query("creta"), hashing_model.embed_query("creta"))
+    assert model.texts == [] and warm.stats()["entries"] == 2
+    assert QueryEmbeddingCache(model, "another-model", path=path).stats()["entries"] == 0
+
+
+class CountingEngine:
+    """An EmbeddingEngine stand-in that remembers what it embedded."""
+
+    def __init__(self, model):
+        self.model = model
+        self.texts = []
+
+    def embed_documents(self, texts, progress=None):
+        self.texts.extend(texts)
+        return np.asarray(self.model.embed_documents(texts), dtype=np.float32)
+
+
+def test_document_cache_is_shared_across_instances_and_survives_reopening(hashing_model, tmp_path):
+    engine = CountingEngine(hashing_model)
+    one = CachedEmbedder(engine, EmbeddingCache(str(tmp_path), "org/model"))
+    other = CachedEmbedder(engine, EmbeddingCache(str(tmp_path), "org/model"))
+    counts = {}
+    vectors = one.embed_documents(["swift diesel", "creta", "swift   diesel"], counts=counts)
+    assert counts == {"cached": 1, "embedded": 2} and engine.texts == ["swift diesel", "creta"]
+    assert np.array_equal(vectors[0], vectors[2])
+
+    # Another process's cache picks up the rows on its next lookup
+    other.embed_documents(["creta", "nexon"], counts=counts)
+    assert counts == {"cached": 1, "embedded": 1} and engine.texts[-1] == "nexon"
+    reopened = EmbeddingCache(str(tmp_path), "org/model")
+    assert len(reopened) == 3
+    found = reopened.lookup([EmbeddingCache.key("nexon")])
+    assert np.array_equal(next(iter(found.values())), hashing_model.embed_query("nexon"))
+
+
+def test_document_cache_drops_rows_written_without_keys(hashing_model, tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model")
+    cache.add([EmbeddingCache.key("a")], np.ones((1, 4), dtype=np.float32))
+    # A writer that crashed between appending vectors and keys
+    with open(cache._vectors_path, "ab") as f:
+        f.write(np.full(4, 9, dtype=np.float32).tobytes())
+    cache.add([EmbeddingCache.key("b")], np.full((1, 4), 2, dtype=np.float32))
+    found = EmbeddingCache(str(tmp_path), "model").lookup([EmbeddingCache.key("a"), EmbeddingCache.key("b")])
+    assert [v.tolist() for v in found.values()] == [[1.0] * 4, [2.0] * 4]
+    with pytest.raises(ValueError):
+        cache.add([EmbeddingCache.key("c")], np.ones((1, 5), dtype=np.float32))
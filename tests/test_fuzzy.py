@@ -0,0 +1,147 @@
+"""The bigram prefilter and FuzzyCorpus against brute-force ``partial_ratio``."""
+import random
+
+import numpy as np
+import pytest
+from rapidfuzz import fuzz
+
+from fuzzy import SCORE_CUTOFF, SNIPPET_CHARS, BigramIndex, FuzzyCorpus, max_partial_ratio
+from storage import ColumnStore
+
+ALPHABETS = ["abcde ", "ab", "abc\0", "aé漢 b"]
+WORDS = "hyundai creta swift diesel petrol sunroof tata nexon ev honda city automatic manual pune 2019 km".split()
+
+
+def random_text(rng, alphabet, longest=12):
+    return "".join(rng.choice(alphabet) for _ in range(rng.randint(0, longest)))
+
+
+def mutate(rng, text):
+    chars = list(text)
+    for _ in range(rng.randint(0, 3)):
+        i = rng.randint(0, len(chars))
+        op = rng.random()
+        if op < .33:
+            chars.insert(i, rng.choice("abcdeéfgh "))
+        elif chars:
+            i = min(i, len(chars) - 1)
+            if op < .66:
+                chars.pop(i)
+            else:
+                chars[i] = rng.choice("abcdeéfgh ")
+    return "".join(chars)
+
+
+def reference_hits(query, titles, urls, contents):
+    """The fuzzy stage as originally written: every document scored in a loop."""
+    hits = []
+    for title, url, content in zip(titles, urls, contents):
+        score_title = fuzz.partial_ratio(query, title.lower())
+        score_content = fuzz.partial_ratio(query, content.lower())
+        score = max(score_title, score_content)
+        if score >= 80:
+            if score_title == 100:
+                boosted_score = 200
+            elif score_content == 100:
+                boosted_score = 180
+            elif score_title > score_content:
+                boosted_score = score + 50
+            else:
+                boosted_score = score
+            hits.append({
+                "title": title, "url": url, "snippet": content[:SNIPPET_CHARS],
+                "score": boosted_score, "source": "fuzzy",
+            })
+    return hits
+
+
+def open_corpus(path, titles, urls, contents, **kwargs):
+    lowered = {"title_lower": [t.lower() for t in titles], "content_lower": [c.lower() for c in contents]}
+    columns = {"title": titles, "url": urls, "content": contents}
+    ColumnStore.write(str(path), dict(columns, **lowered))
+    docs = ColumnStore(str(path), list(columns) + list(lowered), len(titles))
+    indexes = [BigramIndex.build(lowered[name]) for name in ("title_lower", "content_lower")]
+    return FuzzyCorpus(docs, *indexes, **kwargs)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_candidates_keep_every_row_that_reaches_the_cutoff(seed):
+    rng = random.Random(seed)
+    for _ in range(2000):
+        alphabet = rng.choice(ALPHABETS)
+        texts = [random_text(rng, alphabet) for _ in range(30)]
+        query = random_text(rng, alphabet.replace("\0", ""), 8) or "a"
+        rows = BigramIndex.build(texts).candidates(query)
+        kept = set(range(len(texts))) if rows is None else set(rows.tolist())
+        for row, text in enumerate(texts):
+            if fuzz.partial_ratio(query, text) >= SCORE_CUTOFF:
+                assert row in kept, (query, text)
+
+
+def test_max_partial_ratio_bounds_the_score():
+    rng = random.Random(0)
+    for _ in range(20000):
+        alphabet = rng.choice(ALPHABETS[:2])
+        query = random_text(rng, alphabet, 10) or "a"
+        text = random_text(rng, alphabet, 20)
+        if len(text) < len(query):
+            continue
+        bigrams = {text[i:i + 2] for i in range(len(text) - 1)}
+        shared = sum(query[i:i + 2] in bigrams for i in range(len(query) - 1))
+        assert fuzz.partial_ratio(query, text) <= max_partial_ratio(len(query), shared) + 1e-9
+
+
+def test_patched_index_equals_a_rebuild():
+    rng = random.Random(0)
+    for _ in range(300):
+        texts = [random_text(rng, "abcdé漢 \0", 15) for _ in range(rng.randint(0, 60))]
+        kept = np.array(sorted(rng.sample(range(len(texts)), rng.randint(0, len(texts)))), dtype=np.int64)
+        updated = [texts[row] for row in kept]
+        retitled = sorted(rng.sample(range(len(kept)), rng.randint(0, len(kept))))
+        for row in retitled:
+            updated[row] = random_text(rng, "abcdé漢 \0", 15)
+        updated += [random_text(rng, "abcdé漢 \0", 15) for _ in range(rng.randint(0, 10))]
+        changed = np.array(retitled + list(range(len(kept), len(updated))), dtype=np.int64)
+
+        patched = BigramIndex.build(texts).patched(kept, len(updated), changed, [updated[row] for row in changed])
+        rebuilt = BigramIndex.build(updated)
+        for name in ("keys", "offsets", "rows", "lengths"):
+            assert np.array_equal(getattr(patched, name), getattr(rebuilt, name)), name
+
+
+@pytest.fixture(scope="module")
+def catalog():
+    rng = random.Random(3)
+    titles = [" ".join(rng.sample(WORDS, rng.randint(1, 4))).title() for _ in range(1500)]
+    contents = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(0, 40))) for _ in range(1000)]
+    contents += [random_text(rng, "abcdeéfghij klmno", 30) for _ in range(500)]
+    urls = [f"u{i}" for i in range(1500)]
+    queries = []
+    for _ in range(300):
+        if rng.random() < .7:
+            queries.append(mutate(rng, " ".join(rng.sample(WORDS, rng.randint(1, 3)))).lower())
+        else:
+            queries.append(random_text(rng, "abcdeéfghij klmno", 25))
+    queries += ["c", "cr", "cre", "e", "ti", " ", "zzz"]
+    return titles, urls, contents, [q for q in queries if q]
+
+
+def test_search_matches_the_reference(tmp_path, catalog):
+    titles, urls, contents, queries = catalog
+    corpus = open_corpus(tmp_path, titles, urls, contents)
+    for query in queries:
+        assert corpus.search(query) == reference_hits(query, titles, urls, contents), query
+
+
+def test_search_of_a_row_range_matches_the_reference(tmp_path, catalog):
+    titles, urls, contents, queries = catalog
+    corpus = open_corpus(tmp_path, titles, urls, contents, start=200, stop=700)
+    for query in queries[:100]:
+        assert corpus.search(query) == reference_hits(query, titles[200:700], urls[200:700], contents[200:700])
+
+
+def test_versions_without_lowered_columns_match(tmp_path, catalog):
+    titles, urls, contents, queries = catalog
+    corpus = open_corpus(tmp_path, titles, urls, contents, lowered=False)
+    for query in queries[:100]:
+        assert corpus.search(query) == reference_hits(query, titles, urls, contents)
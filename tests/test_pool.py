@@ -0,0 +1,90 @@
+"""Small tenants sharing the pool: isolation, freshness and graduation."""
+import os
+
+import storage
+from test_storage import assert_self_top1, doc, embed
+
+
+def pooled_docs(tenant, count, version=0):
+    return [dict(doc(i, version), url=f"{tenant}/u{i}", content=f"{tenant} content {i} v{version}")
+            for i in range(count)]
+
+
+def upload(root, tenant, docs, pool_max_docs=12, **kwargs):
+    return storage.update_tenant_index(root, tenant, docs, embed, pool_max_docs=pool_max_docs, **kwargs)
+
+
+def test_pooled_tenants_see_only_their_own_docs(tmp_path):
+    root = str(tmp_path)
+    for tenant, count in [("a", 5), ("b", 7), ("c", 3)]:
+        kb, _ = upload(root, tenant, pooled_docs(tenant, count))
+        assert isinstance(kb, storage.PooledTenant)
+    assert not os.path.exists(os.path.join(storage.tenant_dir(root, "a"), storage.CURRENT_FILE))
+
+    for tenant, count in [("a", 5), ("b", 7), ("c", 3)]:
+        kb = storage.load_tenant(root, tenant)
+        urls = {f"{tenant}/u{i}" for i in range(count)}
+        assert_self_top1(kb, urls)
+        # Even a query closest to another tenant's doc only finds this tenant's
+        found = kb.similarity_search_with_score_by_vector(embed(["b content 1 v0"])[0], k=20)
+        assert {d["url"] for d, _ in found} == urls
+        assert {h["url"] for h in kb.fuzzy.search("content")} == urls
+
+
+def test_a_pooled_write_reloads_no_other_tenant(tmp_path):
+    root = str(tmp_path)
+    upload(root, "a", pooled_docs("a", 5))
+    upload(root, "b", pooled_docs("b", 5))
+    stamp_b = storage.current_stamp(root, "b")
+    stamp_a = storage.current_stamp(root, "a")
+    kb, summary = upload(root, "a", pooled_docs("a", 2, 1), replace=True)
+    assert summary["updated"] == 2 and summary["deleted"] == 3
+    assert storage.current_stamp(root, "a") != stamp_a and storage.current_stamp(root, "b") == stamp_b
+    assert_self_top1(kb, {"a/u0", "a/u1"})
+    assert_self_top1(storage.load_tenant(root, "b"), {f"b/u{i}" for i in range(5)})
+
+
+def test_tenants_graduate_past_the_pool_size(tmp_path):
+    root = str(tmp_path)
+    upload(root, "a", pooled_docs("a", 5))
+    upload(root, "b", pooled_docs("b", 5))
+    kb, _ = upload(root, "a", pooled_docs("a", 20))
+    assert isinstance(kb, storage.TenantIndex) and kb.index_spec.get("pooled") is None
+    assert "a" not in storage._read_manifest(root)["tenants"]
+    assert_self_top1(storage.load_tenant(root, "a"), {f"a/u{i}" for i in range(20)})
+    assert_self_top1(storage.load_tenant(root, "b"), {f"b/u{i}" for i in range(5)})
+
+    # With pooling off, a pooled tenant graduates on its next upload however small
+    kb, _ = upload(root, "b", pooled_docs("b", 1), pool_max_docs=0, delete_ids=["b/u4"])
+    assert isinstance(kb, storage.TenantIndex)
+    assert storage._read_manifest(root)["tenants"] == {}
+    assert_self_top1(kb, {f"b/u{i}" for i in range(4)})
+
+
+def test_emptied_pooled_tenant_keeps_an_empty_kb(tmp_path):
+    root = str(tmp_path)
+    upload(root, "a", pooled_docs("a", 3))
+    kb, summary = upload(root, "a", [], delete_ids=["a/u0", "a/u1", "a/u2"])
+    assert summary["deleted"] == 3 and len(kb) == 0
+    assert kb.similarity_search_with_score_by_vector(embed(["a content 0 v0"])[0]) == []
+
+
+def test_segments_are_merged_as_they_turn_to_garbage(tmp_path):
+    root = str(tmp_path)
+    for i in range(40):
+        upload(root, f"t{i}", pooled_docs(f"t{i}", 2))
+    for round_ in range(1, 4):
+        for i in range(0, 40, 3):
+            upload(root, f"t{i}", pooled_docs(f"t{i}", 2, round_))
+    manifest = storage._read_manifest(root)
+    assert len(manifest["segments"]) <= storage._MAX_SEGMENTS
+    live = sum(e["stop"] - e["start"] for e in manifest["tenants"].values())
+    # No segment is more than half garbage
+    assert live == 80 and sum(manifest["segments"].values()) <= 2 * live
+    on_disk = [name for name in os.listdir(storage.tenant_dir(root, storage.POOL_DIR)) if name.startswith("s")]
+    # Only the previous MANIFEST's segments are kept beside the live ones
+    assert len(on_disk) <= 2 * storage._MAX_SEGMENTS
+    for i in range(40):
+        version = 3 if i % 3 == 0 else 0
+        assert_self_top1(storage.load_tenant(root, f"t{i}"), {f"t{i}/u0", f"t{i}/u1"})
+        assert next(storage.load_tenant(root, f"t{i}").documents())["content"] == f"t{i} content 0 v{version}"
@@ -0,0 +1,102 @@
+"""/search/batch and /search/stream return exactly what /search does."""
+import json
+import random
+import time
+
+import pytest
+
+WORDS = "creta diesel petrol swift nexon ev sunroof manual automatic white red seltos venue city alto".split()
+
+
+@pytest.fixture(scope="module")
+def client(app_module):
+    client = app_module.app.test_client()
+    rng = random.Random(3)
+    # "p" is small enough to be pooled
+    for tenant, count, pool_max_docs in [("a", 40, 0), ("b", 300, 0), ("c", 8, 0), ("p", 10, 12)]:
+        docs = [{
+            "title": " ".join(rng.sample(WORDS, 2)) + f" {i}",
+            "url": f"{tenant}/{i}",
+            "content": " ".join(rng.choices(WORDS, k=12)),
+        } for i in range(count)]
+        app_module.POOL_MAX_DOCS = pool_max_docs
+        try:
+            assert client.post("/upload", json={"tenant_id": tenant, "docs": docs}).status_code == 200
+        finally:
+            app_module.POOL_MAX_DOCS = 0
+    assert client.get("/stats").json is not None
+    return client
+
+
+@pytest.fixture(scope="module")
+def queries():
+    rng = random.Random(5)
+    return [{
+        "tenant_id": rng.choice("abcp"),
+        "query": " ".join(rng.sample(WORDS, rng.randint(1, 3)))[:rng.randint(1, 20)],
+    } for _ in range(120)]
+
+
+def search(client, entry):
+    return client.get("/search", query_string=entry).json
+
+
+def test_batch_matches_search(client, queries):
+    entries = queries + [{"tenant_id": "zz", "query": "x"}, {"query": "creta"}, "junk", {"tenant_id": "a", "query": "CRETA"}]
+    results = client.post("/search/batch", json={"queries": entries}).json["results"]
+    for entry, result in zip(queries, results):
+        assert result == search(client, entry), entry
+    assert results[-4]["status"] == 404
+    assert results[-3]["status"] == 400 and results[-2]["status"] == 400
+    assert results[-1] == search(client, {"tenant_id": "a", "query": "creta"})
+
+
+def test_batch_reports_bad_tenant_ids_per_entry(client):
+    entries = [{"tenant_id": 7, "query": "x"}, {"tenant_id": ["a"], "query": "x"}, {"tenant_id": "a", "query": "creta"}]
+    response = client.post("/search/batch", json={"queries": entries})
+    assert response.status_code == 200
+    results = response.json["results"]
+    assert [r["status"] for r in results[:2]] == [400, 400]
+    assert results[2] == search(client, entries[2])
+
+
+def test_batch_rejects_bad_requests(client):
+    assert client.post("/search/batch", json={}).status_code == 400
+    assert client.post("/search/batch", json={"queries": []}).status_code == 400
+
+
+def test_stream_ends_with_the_search_page(client, queries):
+    for entry in queries[:40]:
+        response = client.get("/search/stream", query_string=entry)
+        assert response.mimetype == "application/x-ndjson"
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        assert [line["final"] for line in lines] == [False] * (len(lines) - 1) + [True]
+        assert lines[0]["stage"] == "fuzzy"
+        assert lines[-1]["results"] == search(client, entry), entry
+
+
+@pytest.mark.parametrize("mode", ["0", "auto", "1"])
+def test_parallel_semantic_stage_does_not_change_results(client, queries, app_module, monkeypatch, mode):
+    monkeypatch.setattr(app_module, "PARALLEL_SEARCH", "0")
+    expected = [search(client, entry) for entry in queries[:40]]
+    monkeypatch.setattr(app_module, "PARALLEL_SEARCH", mode)
+    assert [search(client, entry) for entry in queries[:40]] == expected
+
+
+@pytest.mark.parametrize("mode", ["0", "auto"])
+def test_budget_bounds_the_semantic_stage(client, app_module, monkeypatch, mode):
+    semantic_search = app_module.semantic_search
+
+    def slow_semantic_search(vectorstore, query):
+        time.sleep(0.5)
+        return semantic_search(vectorstore, query)
+
+    monkeypatch.setattr(app_module, "PARALLEL_SEARCH", mode)
+    monkeypatch.setattr(app_module, "SEARCH_BUDGET_MS", 100)
+    monkeypatch.setattr(app_module, "semantic_search", slow_semantic_search)
+    over_budget = app_module.search_stats.over_budget
+    started = time.perf_counter()
+    # Nothing matches fuzzily, so the page needs the semantic stage
+    assert search(client, {"tenant_id": "b", "query": "qqqqqq"}) == []
+    assert time.perf_counter() - started < 0.4
+    assert app_module.search_stats.over_budget == over_budget + 1
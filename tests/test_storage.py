@@ -0,0 +1,165 @@
+"""Tenant KBs on disk: updates patch the index without losing or mismapping documents."""
+import hashlib
+import pickle
+
+import numpy as np
+import pytest
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import Embeddings
+
+import storage
+import vector_index
+
+DIM = 16
+
+
+def embed(texts):
+    """A random vector per text, so every document is its own nearest neighbour."""
+    return np.stack([
+        np.random.default_rng(int(hashlib.md5(t.encode()).hexdigest()[:8], 16)).standard_normal(DIM)
+        for t in texts
+    ]).astype(np.float32)
+
+
+def doc(i, version=0):
+    return {"title": f"doc {i}", "url": f"u{i}", "content": f"content {i} v{version}"}
+
+
+def assert_self_top1(kb, expected_urls):
+    """Every document's own vector finds it first, and nothing else is left."""
+    assert sorted(d["url"] for d in kb.documents()) == sorted(expected_urls)
+    vectors = embed([d["content"] for d in kb.documents()])
+    found = kb.similarity_search_with_score_by_vectors(vectors, k=1)
+    assert [hits[0][0]["url"] for hits in found] == [d["url"] for d in kb.documents()]
+
+
+@pytest.mark.parametrize("kind", [vector_index.FLAT, vector_index.HNSW, vector_index.IVF])
+def test_upsert_and_delete_keep_every_doc_its_own_top1(tmp_path, kind):
+    # nprobe past nlist scans every list, so IVF is exact here too; HNSW is
+    # built thoroughly and keeps its tombstones through the whole test
+    options = {"type": kind, "nprobe": 10000, "ef_construction": 200, "ef_search": 200, "hnsw_max_deleted": 0.5}
+    kb, _ = storage.update_tenant_index(str(tmp_path), "t", [doc(i) for i in range(600)], embed,
+                                        index_options=options)
+    assert kb.index_spec["type"] == kind
+    urls = {f"u{i}" for i in range(600)}
+    assert_self_top1(kb, urls)
+
+    # New content for some docs, new docs, and deletions, in one upsert
+    deleted = {f"u{i}" for i in range(3, 600, 11) if i % 7}
+    kb, summary = storage.update_tenant_index(
+        str(tmp_path), "t", [doc(i, 1) for i in range(0, 600, 7)] + [doc(i) for i in range(600, 620)], embed,
+        delete_ids=sorted(deleted), index_options=options,
+    )
+    assert (summary["updated"], summary["added"], summary["deleted"]) == (len(range(0, 600, 7)), 20, len(deleted))
+    urls = (urls | {f"u{i}" for i in range(600, 620)}) - deleted
+    assert_self_top1(kb, urls)
+    if kind == vector_index.HNSW:
+        # Patched, not rebuilt: the replaced and deleted vectors are tombstones
+        assert kb.index_stats()["deleted"] > 0
+
+    # A delete on its own
+    kb, _ = storage.update_tenant_index(str(tmp_path), "t", [], embed, delete_ids=["u1", "u2", "u610"],
+                                        index_options=options)
+    assert_self_top1(kb, urls - {"u1", "u2", "u610"})
+
+
+@pytest.mark.parametrize("kind,compression", [
+    (vector_index.FLAT, vector_index.SQ8), (vector_index.HNSW, vector_index.SQ8), (vector_index.HNSW, vector_index.PQ),
+])
+def test_compressed_kb_can_be_emptied_and_refilled(tmp_path, kind, compression):
+    options = {"type": kind, "compression": compression}
+    kb, _ = storage.update_tenant_index(str(tmp_path), "t", [doc(i) for i in range(100)], embed,
+                                        index_options=options)
+    assert kb.index_spec["compression"] == vector_index.SQ8
+
+    kb, summary = storage.update_tenant_index(str(tmp_path), "t", [], embed,
+                                              delete_ids=[f"u{i}" for i in range(100)], index_options=options)
+    assert summary["deleted"] == 100 and len(kb) == 0
+    assert kb.similarity_search_with_score_by_vector(embed(["content 1 v0"])[0]) == []
+
+    kb, _ = storage.update_tenant_index(str(tmp_path), "t", [doc(i) for i in range(50)], embed,
+                                        index_options=options)
+    assert kb.index_spec["compression"] == vector_index.SQ8 and len(kb) == 50
+
+
+class CountingEmbed:
+    """``embed`` that remembers every text it was asked for."""
+
+    def __init__(self):
+        self.texts = []
+
+    def __call__(self, texts):
+        self.texts.extend(texts)
+        return embed(texts)
+
+
+def test_replace_keeps_exactly_the_posted_docs_and_embeds_only_new_content(tmp_path):
+    root = str(tmp_path)
+    storage.update_tenant_index(root, "t", [doc(i) for i in range(10)], embed)
+    counting = CountingEmbed()
+    posted = [doc(i) for i in range(5)] + [doc(5, 1)] + [doc(i) for i in range(10, 12)]
+    kb, summary = storage.update_tenant_index(root, "t", posted, counting, replace=True)
+    assert summary == {"added": 2, "updated": 1, "unchanged": 5, "deleted": 4, "new_vectors": 3}
+    assert sorted(counting.texts) == sorted(d["content"] for d in posted[5:])
+    assert [d["url"] for d in kb.documents()] == [f"u{i}" for i in [0, 1, 2, 3, 4, 5, 10, 11]]
+    assert_self_top1(kb, {d["url"] for d in posted})
+
+
+def test_upsert_patches_metadata_without_embedding(tmp_path):
+    root = str(tmp_path)
+    storage.update_tenant_index(root, "t", [doc(i) for i in range(10)], embed)
+    counting = CountingEmbed()
+    retitled = dict(doc(3), title="renamed")
+    kb, summary = storage.update_tenant_index(root, "t", [retitled, doc(4)], counting, delete_ids=["u7", "nope"])
+    assert summary == {"added": 0, "updated": 1, "unchanged": 1, "deleted": 1, "new_vectors": 0}
+    assert counting.texts == []
+    assert kb.document(3)["title"] == "renamed"
+    assert kb.fuzzy.search("renamed")[0]["url"] == "u3"
+    assert_self_top1(kb, {f"u{i}" for i in range(10)} - {"u7"})
+
+    # Nothing changed: no new version
+    version = kb.version
+    kb, summary = storage.update_tenant_index(root, "t", [retitled], counting)
+    assert summary["unchanged"] == 1 and kb.version == version
+
+
+def test_explicit_ids_and_duplicate_urls(tmp_path):
+    docs = [dict(doc(1), id="a"), dict(doc(2), url="same"), dict(doc(3), url="same")]
+    kb, _ = storage.update_tenant_index(str(tmp_path), "t", docs, embed)
+    assert len(kb) == 3
+    # Docs sharing a url are told apart by position: the second "same" posted
+    # is the third doc, whose content changes
+    reposted = [dict(doc(2), url="same"), dict(doc(9), url="same")]
+    kb, summary = storage.update_tenant_index(str(tmp_path), "t", reposted, embed)
+    assert (summary["updated"], summary["unchanged"], summary["added"]) == (1, 1, 0)
+    assert sorted(d["content"] for d in kb.documents()) == ["content 1 v0", "content 2 v0", "content 9 v0"]
+
+
+class LegacyEmbeddings(Embeddings):
+    """``embed`` as the LangChain model the legacy pickles were built with."""
+
+    def embed_documents(self, texts):
+        return embed(texts).tolist()
+
+    def embed_query(self, text):
+        return embed([text])[0].tolist()
+
+
+def test_legacy_pickle_is_migrated_with_its_docs(tmp_path):
+    root = str(tmp_path)
+    legacy = FAISS.from_texts([f"content {i} v0" for i in range(6)], embedding=LegacyEmbeddings(),
+                              metadatas=[{"title": f"doc {i}", "url": f"u{i}"} for i in range(6)])
+    with open(storage.legacy_pickle_path(root, "t"), "wb") as f:
+        pickle.dump(legacy, f)
+
+    assert storage.load_tenant(root, "t") is None
+    kb = storage.migrate_legacy_pickle(root, "t")
+    assert list(kb.documents()) == [doc(i) for i in range(6)]
+    assert_self_top1(kb, {f"u{i}" for i in range(6)})
+
+    # An upload to a tenant that only has a legacy KB starts from its docs
+    with open(storage.legacy_pickle_path(root, "u"), "wb") as f:
+        pickle.dump(legacy, f)
+    kb, summary = storage.update_tenant_index(root, "u", [doc(6)], embed)
+    assert summary["added"] == 1 and summary["unchanged"] == 0
+    assert_self_top1(kb, {f"u{i}" for i in range(7)})
@@ -0,0 +1,84 @@
+"""/upload: replace, upsert and delete, synchronously and as jobs."""
+import threading
+import time
+
+import pytest
+
+from jobs import JobRegistry
+
+
+@pytest.fixture(scope="module")
+def client(app_module):
+    return app_module.app.test_client()
+
+
+def docs(prefix, count, version=0):
+    return [{"title": f"{prefix} car {i}", "url": f"{prefix}/{i}", "content": f"{prefix} diesel {i} v{version}"}
+            for i in range(count)]
+
+
+def test_numeric_tenant_id_is_stored_as_text(client):
+    response = client.post("/upload", json={"tenant_id": 7, "docs": docs("n", 3)})
+    assert response.status_code == 200 and response.json["total_docs"] == 3
+    assert client.get("/search", query_string={"tenant_id": "7", "query": "n car 1"}).json[0]["url"] == "n/1"
+    assert client.post("/upload", json={"tenant_id": ["7"], "docs": docs("n", 3)}).status_code == 400
+
+
+def test_upload_reports_cache_hits_apart_from_model_work(client):
+    first = client.post("/upload", json={"tenant_id": "e1", "docs": docs("cachehit", 5)}).json
+    assert first["changes"]["new_vectors"] == 5
+    assert (first["embedding"]["cached"], first["embedding"]["embedded"]) == (0, 5)
+    # The same contents for another tenant come from the embedding cache
+    second = client.post("/upload", json={"tenant_id": "e2", "docs": docs("cachehit", 5)}).json
+    assert second["changes"]["new_vectors"] == 5
+    assert (second["embedding"]["cached"], second["embedding"]["embedded"]) == (5, 0)
+
+
+def wait_for(client, job):
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        status = client.get(job["status_url"]).json
+        if status["status"] in ("succeeded", "failed"):
+            return status
+        time.sleep(0.02)
+    raise AssertionError(f"job {job['job_id']} did not finish")
+
+
+def test_async_upload_reports_progress_and_result(client):
+    response = client.post("/upload?async=1", json={"tenant_id": "job", "docs": docs("job", 30)})
+    assert response.status_code == 202
+    status = wait_for(client, response.json)
+    assert status["status"] == "succeeded" and status["tenant_id"] == "job"
+    assert status["docs_to_embed"] == 30 and status["docs_embedded"] == 30
+    assert status["result"]["total_docs"] == 30
+    assert client.get("/search", query_string={"tenant_id": "job", "query": "job car 7"}).json[0]["url"] == "job/7"
+
+    # An upsert that deletes everything a tenant never had fails as a job
+    response = client.post("/upload", json={"tenant_id": "nojob", "mode": "upsert", "delete": ["x"], "async": True})
+    status = wait_for(client, response.json)
+    assert status["status"] == "failed" and "nojob" in status["error"]
+    assert client.get("/jobs/unknown").status_code == 404
+
+
+def test_jobs_are_visible_to_other_workers_and_pruned(tmp_path):
+    registry = JobRegistry(str(tmp_path), workers=1, keep=2)
+    other_worker = JobRegistry(str(tmp_path))
+    release = threading.Event()
+    running = registry.submit("t", 1, lambda job: release.wait(5) and {"ok": True})
+    assert other_worker.get(running.id)["status"] in ("queued", "running")
+    release.set()
+    for _ in range(250):
+        if other_worker.get(running.id)["status"] == "succeeded":
+            break
+        time.sleep(0.02)
+    assert other_worker.get(running.id)["result"] == {"ok": True}
+
+    failing = registry.submit("t", 1, lambda job: 1 / 0)
+    registry.submit("t", 1, lambda job: None)
+    # Only the last `keep` jobs are remembered
+    assert other_worker.get(running.id) is None
+    for _ in range(250):
+        if registry.get(failing.id)["status"] == "failed":
+            break
+        time.sleep(0.02)
+    assert "division by zero" in registry.get(failing.id)["error"]
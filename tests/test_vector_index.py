@@ -0,0 +1,91 @@
+"""Index structure and compression chosen by KB size, and how updates treat them."""
+import numpy as np
+import pytest
+
+import storage
+import vector_index
+from test_storage import assert_self_top1, doc, embed
+
+
+@pytest.mark.parametrize("count,kind", [(0, "flat"), (19999, "flat"), (20000, "hnsw"), (249999, "hnsw"),
+                                        (250000, "ivf")])
+def test_auto_type_follows_kb_size(count, kind):
+    assert vector_index.choose_spec(count, 384)["type"] == kind
+
+
+def test_ivf_falls_back_to_flat_below_one_list():
+    assert vector_index.choose_spec(39, 384, {"type": "ivf"})["type"] == "flat"
+    spec = vector_index.choose_spec(4000, 384, {"type": "ivf"})
+    assert spec["nlist"] == 100 and spec["nprobe"] == 6
+
+
+def test_ivf_is_retrained_only_after_4x_growth():
+    spec = vector_index.choose_spec(1000, 384, {"type": "ivf"})
+    assert vector_index.choose_spec(3999, 384, {"type": "ivf"}, spec)["trained_docs"] == 1000
+    assert vector_index.choose_spec(4001, 384, {"type": "ivf"}, spec)["trained_docs"] == 4001
+    assert vector_index.choose_spec(249, 384, {"type": "ivf"}, spec)["trained_docs"] == 249
+
+
+def test_hnsw_is_rebuilt_once_tombstones_pass_the_limit(tmp_path):
+    root = str(tmp_path)
+    options = {"type": "hnsw", "hnsw_max_deleted": 0.1, "ef_construction": 200, "ef_search": 200}
+    storage.update_tenant_index(root, "t", [doc(i) for i in range(200)], embed, index_options=options)
+    kb, _ = storage.update_tenant_index(root, "t", [], embed, delete_ids=[f"u{i}" for i in range(15)],
+                                        index_options=options)
+    assert kb.index_stats()["deleted"] == 15
+    assert_self_top1(kb, {f"u{i}" for i in range(15, 200)})
+    # 15 + 10 tombstones is over 10% of the graph: rebuilt without them
+    kb, _ = storage.update_tenant_index(root, "t", [], embed, delete_ids=[f"u{i}" for i in range(15, 25)],
+                                        index_options=options)
+    assert kb.index_stats()["deleted"] == 0 and kb.index.ntotal == 175
+    assert_self_top1(kb, {f"u{i}" for i in range(25, 200)})
+
+
+def test_search_settings_change_without_a_rebuild():
+    spec = vector_index.choose_spec(30000, 16, {"ef_search": 64})
+    assert vector_index.can_patch(spec, vector_index.choose_spec(30000, 16, {"ef_search": 128}))
+    assert not vector_index.can_patch(spec, vector_index.choose_spec(30000, 16, {"hnsw_m": 16}))
+    assert not vector_index.can_patch(spec, spec, deleted_fraction=0.2)
+
+
+def test_expected_recall_is_measured_for_approximate_indexes():
+    vectors = np.random.default_rng(0).standard_normal((2000, 16)).astype(np.float32)
+    keys = np.arange(len(vectors), dtype=np.int64)
+    flat = vector_index.choose_spec(len(vectors), 16)
+    assert vector_index.measure_recall(vector_index.build(flat, vectors, keys), flat, vectors, keys) == 1.0
+    ivf = vector_index.choose_spec(len(vectors), 16, {"type": "ivf", "nprobe": 1})
+    recall = vector_index.measure_recall(vector_index.build(ivf, vectors, keys), ivf, vectors, keys)
+    assert 0 < recall < 1
+
+
+@pytest.mark.parametrize("compression,max_bytes", [("none", 64), ("fp16", 32), ("sq8", 16)])
+def test_compression_shrinks_the_index(tmp_path, compression, max_bytes):
+    options = {"compression": compression, "rerank": 4}
+    kb, _ = storage.update_tenant_index(str(tmp_path), "t", [doc(i) for i in range(2000)], embed,
+                                        index_options=options)
+    assert kb.index_spec["compression"] == compression
+    # 16 float32 dims are 64 bytes a vector; the id map adds 8, the header a little
+    assert kb.index_stats()["bytes_per_vector"] < max_bytes + 8 + 1
+    # Re-ranking by the exact vectors finds each doc at distance 0
+    hits = kb.similarity_search_with_score_by_vectors(embed([f"content {i} v0" for i in range(0, 2000, 50)]), k=1)
+    assert [h[0][0]["url"] for h in hits] == [f"u{i}" for i in range(0, 2000, 50)]
+    assert all(h[0][1] == 0 for h in hits)
+
+
+def test_pq_needs_enough_docs_to_train(tmp_path):
+    options = {"compression": "pq", "pq_m": 4}
+    assert vector_index.choose_spec(10239, 16, options)["compression"] == "sq8"
+    vectors = np.random.default_rng(0).standard_normal((10240, 16)).astype(np.float32)
+    spec = vector_index.choose_spec(len(vectors), 16, options)
+    index = vector_index.build(spec, vectors, np.arange(len(vectors), dtype=np.int64))
+    assert spec["compression"] == "pq" and index.index.sa_code_size() == 4
+
+
+def test_compressed_kb_is_patched_without_retraining(tmp_path):
+    root = str(tmp_path)
+    options = {"compression": "sq8", "rerank": 4}
+    kb, _ = storage.update_tenant_index(root, "t", [doc(i) for i in range(1000)], embed, index_options=options)
+    kb, _ = storage.update_tenant_index(root, "t", [doc(i) for i in range(1000, 1500)], embed,
+                                        delete_ids=["u0"], index_options=options)
+    assert kb.index_spec["trained_docs"] == 1000
+    assert_self_top1(kb, {f"u{i}" for i in range(1, 1500)})
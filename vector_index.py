@@ -0,0 +1,250 @@
+"""FAISS index structures for tenant KBs, chosen by KB size.
+
+Small KBs get an exact flat index. From ``hnsw_min_docs`` vectors on they
+get HNSW, a neighbour graph searched in roughly logarithmic time, and from
+``ivf_min_docs`` on an inverted file: k-means centroids partition the
+vectors and a search scans only the ``nprobe`` nearest lists. Rows keep their
+stable FAISS ids: flat and HNSW indexes are wrapped in ``IndexIDMap2`` and
+IVF stores the ids in its lists. (``IndexIDMap2.remove_ids`` assumes the
+sub-index renumbers rows as a flat one does, which IVF does not.)
+
+``compression`` (opt-in) stores codes instead of float32 vectors: ``fp16``
+(half the size, near-exact), ``sq8`` (a quarter) or ``pq`` (``pq_m`` bytes a
+vector, 32x smaller at the default). With ``rerank`` set, a search fetches
+``rerank * k`` candidates from the compressed index and orders them by exact
+distance computed from the float32 vectors kept on disk beside it. KBs too
+small to train a codec on step down: ``pq`` to ``sq8`` below 10240 vectors,
+``sq8`` to none below 40 (an emptied KB included).
+
+The chosen structure and its search parameters (``ef_search``, ``nprobe``,
+``rerank``) are stored as an index spec in the version's ``meta.json`` and
+applied again whenever the version is loaded. Because the exact vectors are
+stored beside the index, an index can always be rebuilt from them. Flat and
+IVF indexes are patched in place on update. HNSW cannot remove vectors:
+removed ones stay in its graph as tombstones, which searches skip with an id
+selector, and it is rebuilt once they make up ``hnsw_max_deleted`` of it.
+Trained parts (IVF centroids, SQ ranges,
+PQ codebooks) are retrained once the KB has grown or shrunk 4x since
+training.
+"""
+import math
+
+import faiss
+import numpy as np
+
+FLAT = "flat"
+HNSW = "hnsw"
+IVF = "ivf"
+
+NONE = "none"
+FP16 = "fp16"
+SQ8 = "sq8"
+PQ = "pq"
+
+DEFAULT_OPTIONS = {
+    "type": "auto",  # or one of FLAT, HNSW, IVF for every KB
+    "hnsw_min_docs": 20000,
+    "ivf_min_docs": 250000,
+    "hnsw_m": 32,
+    "ef_construction": 80,
+    "ef_search": 64,
+    "hnsw_max_deleted": 0.1,  # fraction of tombstones that triggers a rebuild
+    "nprobe": 0,  # 0: nlist / 16
+    "compression": NONE,  # or FP16, SQ8, PQ
+    "pq_m": 0,  # PQ bytes per vector; 0: dim / 8
+    "rerank": 0,  # candidates per result re-ranked exactly; 0: off
+}
+
+_CODECS = {NONE: "Flat", FP16: "SQfp16", SQ8: "SQ8"}
+# k-means wants ~40 points per centroid; more only slows training down
+_TRAINING_POINTS_PER_LIST = 40
+# ... and PQ trains 256 centroids per sub-quantizer
+_PQ_MIN_DOCS = _TRAINING_POINTS_PER_LIST * 256
+_RETRAIN_FACTOR = 4
+_SEARCH_PARAMS = ("ef_search", "nprobe", "rerank")
+_TRAINING_STATE = ("nlist", "trained_docs")
+_RECALL_QUERIES = 100
+_RECALL_K = 10
+
+
+def choose_spec(count: int, dim: int, options: dict = None, current: dict = None) -> dict:
+    """Index spec for a KB of ``count`` vectors; ``current`` is the live spec, if any."""
+    options = dict(DEFAULT_OPTIONS, **(options or {}))
+    kind = options["type"]
+    if kind == "auto":
+        kind = FLAT if count < options["hnsw_min_docs"] else HNSW if count < options["ivf_min_docs"] else IVF
+    if kind not in (FLAT, HNSW, IVF):
+        raise ValueError(f"Unknown index type {kind}")
+    if kind == IVF and count < _TRAINING_POINTS_PER_LIST:
+        # Too few vectors to train even one list
+        kind = FLAT
+    compression = options["compression"]
+    if compression not in (NONE, FP16, SQ8, PQ):
+        raise ValueError(f"Unknown compression {compression}")
+    if compression == PQ and count < _PQ_MIN_DOCS:
+        compression = SQ8
+    if compression == SQ8 and count < _TRAINING_POINTS_PER_LIST:
+        # Too few vectors to train ranges on (none, once every doc is
+        # deleted), and too few for compression to matter
+        compression = NONE
+
+    spec = {"type": kind, "compression": compression}
+    if kind == HNSW:
+        spec.update(m=options["hnsw_m"], ef_construction=options["ef_construction"])
+    if compression == PQ:
+        spec["pq_m"] = options["pq_m"] or dim // 8
+        if dim % spec["pq_m"]:
+            raise ValueError(f"pq_m={spec['pq_m']} does not divide the dimension {dim}")
+    if kind == IVF or compression in (SQ8, PQ):
+        if (current and _structure(current, training=False) == _structure(spec, training=False)
+                and current["trained_docs"] / _RETRAIN_FACTOR <= count <= current["trained_docs"] * _RETRAIN_FACTOR):
+            # What was trained still fits the data
+            spec.update({k: current[k] for k in _TRAINING_STATE if k in current})
+        else:
+            if kind == IVF:
+                spec["nlist"] = max(1, min(int(4 * math.sqrt(count)), count // _TRAINING_POINTS_PER_LIST, 65536))
+            spec["trained_docs"] = count
+
+    if kind == HNSW:
+        spec["ef_search"] = options["ef_search"]
+    if kind == IVF:
+        spec["nprobe"] = options["nprobe"] or max(1, spec["nlist"] // 16)
+    if not is_exact(spec):
+        spec["rerank"] = options["rerank"]
+    return spec
+
+
+def is_exact(spec: dict) -> bool:
+    return spec["type"] == FLAT and spec.get("compression", NONE) == NONE
+
+
+def factory_string(spec: dict) -> str:
+    compression = spec.get("compression", NONE)
+    codec = f"PQ{spec['pq_m']}np" if compression == PQ else _CODECS[compression]
+    if spec["type"] == FLAT:
+        return f"IDMap2,{codec}"
+    if spec["type"] == HNSW:
+        return f"IDMap2,HNSW{spec['m']}" + ("" if compression == NONE else f"_{codec}")
+    return f"IVF{spec['nlist']},{codec}"
+
+
+def build(spec: dict, vectors: np.ndarray, keys: np.ndarray):
+    """A fresh index of type ``spec`` holding ``vectors`` under ids ``keys``."""
+    index = faiss.index_factory(vectors.shape[1], factory_string(spec))
+    if spec["type"] == HNSW:
+        faiss.downcast_index(index.index).hnsw.efConstruction = spec["ef_construction"]
+    if not index.is_trained:
+        size = spec.get("nlist", 0) * _TRAINING_POINTS_PER_LIST
+        if spec.get("compression") in (SQ8, PQ):
+            size = max(size, _PQ_MIN_DOCS)
+        index.train(_training_sample(vectors, size))
+    if len(vectors):
+        index.add_with_ids(vectors, keys)
+    configure(index, spec)
+    return index
+
+
+def can_patch(current: dict, spec: dict, deleted_fraction: float = 0.0, options: dict = None) -> bool:
+    """Whether an index built as ``current`` can be updated in place to ``spec``.
+
+    ``deleted_fraction`` is the share of the patched index's vectors that
+    would be tombstones (see ``keeps_tombstones``).
+    """
+    if current is None or _structure(current) != _structure(spec):
+        return False
+    options = dict(DEFAULT_OPTIONS, **(options or {}))
+    return not keeps_tombstones(spec) or deleted_fraction <= options["hnsw_max_deleted"]
+
+
+def holds_ids_as_built(index, spec: dict) -> bool:
+    """False for an IVF index wrapped in ``IndexIDMap2``, as they were first
+    built: removing ids from one mismaps the rest, so it must be rebuilt."""
+    return spec["type"] != IVF or not isinstance(index, faiss.IndexIDMap2)
+
+
+def keeps_tombstones(spec: dict) -> bool:
+    """Whether removed vectors stay in the index, to be skipped at search time."""
+    return spec["type"] == HNSW
+
+
+def excluding(spec: dict, ids: np.ndarray):
+    """Search parameters that skip ``ids`` (None if there are none), carrying
+    ``spec``'s search-time settings, which parameters override."""
+    if ids is None or not len(ids):
+        return None
+    sel = faiss.IDSelectorNot(faiss.IDSelectorBatch(np.ascontiguousarray(ids, dtype=np.int64)))
+    if spec["type"] == HNSW:
+        return faiss.SearchParametersHNSW(sel=sel, efSearch=spec["ef_search"])
+    if spec["type"] == IVF:
+        return faiss.SearchParametersIVF(sel=sel, nprobe=spec["nprobe"])
+    return faiss.SearchParameters(sel=sel)
+
+
+def configure(index, spec: dict):
+    """Apply the search-time parameters of ``spec`` to a built or loaded index."""
+    if spec["type"] == HNSW:
+        faiss.downcast_index(index.index).hnsw.efSearch = spec["ef_search"]
+    elif spec["type"] == IVF:
+        faiss.extract_index_ivf(index).nprobe = spec["nprobe"]
+
+
+def search(index, spec: dict, queries: np.ndarray, k: int, keys=None, vectors=None, params=None):
+    """``index.search``, re-ranked by exact distance when ``spec`` asks for it.
+
+    ``keys`` and ``vectors`` are the FAISS id and exact vector of each row;
+    without them no re-ranking is done. ``params`` are FAISS search
+    parameters, e.g. an id selector.
+    """
+    rerank = spec.get("rerank", 0) if vectors is not None else 0
+    if not rerank:
+        return index.search(queries, k, params=params)
+    _, candidates = index.search(queries, k * rerank, params=params)
+    distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+    ids = np.full((len(queries), k), -1, dtype=np.int64)
+    for q, found in enumerate(candidates):
+        found = found[found != -1]
+        exact = _exact_distances(queries[q], vectors, np.searchsorted(keys, found))
+        # Ties go to the lower id, as in an exact flat search
+        order = np.lexsort((found, exact))[:k]
+        distances[q, :len(order)] = exact[order]
+        ids[q, :len(order)] = found[order]
+    return distances, ids
+
+
+def measure_recall(index, spec: dict, vectors: np.ndarray, keys: np.ndarray, params=None) -> float:
+    """Recall@10 of ``search`` against exact search, on a sample of the KB's own vectors.
+
+    A result counts as found if it is at least as close as the true 10th
+    neighbour, so duplicate vectors do not count as misses. ``params`` are
+    passed to the search, e.g. to skip tombstones.
+    """
+    if is_exact(spec) or not len(vectors):
+        return 1.0
+    k = min(_RECALL_K, len(vectors))
+    queries = np.ascontiguousarray(_training_sample(vectors, _RECALL_QUERIES))
+    true_distances, _ = faiss.knn(queries, np.ascontiguousarray(vectors), k)
+    _, found = search(index, spec, queries, k, keys, vectors, params)
+    hits = 0
+    for q, ids in enumerate(found):
+        ids = ids[ids != -1]
+        exact = _exact_distances(queries[q], vectors, np.searchsorted(keys, ids))
+        hits += min(k, int(np.sum(exact <= true_distances[q, -1] * (1 + 1e-5) + 1e-6)))
+    return round(hits / (k * len(queries)), 4)
+
+
+def _exact_distances(query: np.ndarray, vectors, rows: np.ndarray) -> np.ndarray:
+    return ((np.asarray(vectors[rows], dtype=np.float32) - query) ** 2).sum(axis=1)
+
+
+def _structure(spec: dict, training: bool = True) -> dict:
+    # Everything but the search-time parameters, which configure() can change
+    # (and, with training=False, what retraining would change)
+    skip = _SEARCH_PARAMS if training else _SEARCH_PARAMS + _TRAINING_STATE
+    return {k: v for k, v in spec.items() if k not in skip}
+
+
+def _training_sample(vectors: np.ndarray, size: int) -> np.ndarray:
+    if len(vectors) <= size:
+        return vectors
+    rows = np.sort(np.random.default_rng(0).choice(len(vectors), size, replace=False))
+    return vectors[rows]